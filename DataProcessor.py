@@ -3,9 +3,124 @@
 # Description: This modules defines the DataProcessor class that handles the Spotify data upload and preprocesses features to be suitable for K-Means Clustering and cosine similarity calculations. 
 
 
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
 import pandas as pd 
 import numpy as np 
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+from Metrics import metrics
+
+FEATURE_COLS = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']   # numeric features used for clustering and similarity
+REQUIRED_COLS = ['id', 'name', 'artists'] + FEATURE_COLS
+ARTIFACT_VERSION = 3   # bump when the artifact layout or the pipeline math changes
+CACHE_VERSION = 1      # bump when the compact dtypes or the sidecar cache layout change
+
+# explicit dtypes for the compact loader: float32 features and categorical artists (artists repeat across many songs)
+COMPACT_DTYPES = {'id': str, 'name': str, 'artists': 'category', **{col: np.float32 for col in FEATURE_COLS}}
+
+
+def _encodeStrings(values):
+    '''
+    Packs strings into one UTF-8 buffer, so storage grows with the total text length instead of rows x longest string
+    params: values(iterable) = strings to pack
+    returns: (np.ndarray, np.ndarray) = uint8 buffer and int64 byte offsets, row i is buffer[offsets[i]:offsets[i + 1]]
+    '''
+    encoded = [str(value).encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decodeStrings(data, offsets):
+    '''
+    Unpacks a buffer written by _encodeStrings
+    returns: list = the strings
+    '''
+    n = len(offsets) - 1
+    if n and not (data == 0).any():
+        # put a NUL after every string and split the decoded buffer in C instead of slicing row by row
+        joined = np.zeros(len(data) + n, dtype=np.uint8)
+        keep = np.ones(len(joined), dtype=bool)
+        keep[offsets[1:] + np.arange(n)] = False
+        joined[keep] = data
+        return bytes(joined).decode('utf-8').split('\x00')[:-1]
+    buffer = bytes(data)
+    return [buffer[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def _fileHash(path, chunk_size=1 << 20):
+    '''
+    SHA-256 of a file, read in chunks so large datasets don't have to fit in memory
+    params: path(str) = file to hash, chunk_size(int) = bytes per read
+    returns: str = hex digest
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sourceFingerprint(path, previous=None):
+    '''
+    Size, modification time and SHA-256 of a file. The hash from a previous fingerprint is reused when the
+    size and modification time still match, so unchanged files are not re-read
+    params: path(str) = file to fingerprint, previous(dict) = fingerprint recorded earlier, if any
+    returns: dict = size, mtime_ns and sha256
+    '''
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(k) == fingerprint[k] for k in fingerprint):
+        fingerprint['sha256'] = previous['sha256']
+    else:
+        fingerprint['sha256'] = _fileHash(path)
+    return fingerprint
+
+
+SILHOUETTE_SIZE = 2000  # songs of the sample the silhouette is computed on, its cost grows with the square of this
+
+_worker_values = None   # sampled feature frame shared with each worker process by _initWorker
+
+
+def _initWorker(values):
+    global _worker_values
+    _worker_values = values
+
+
+def _evaluateK(k, scale):
+    '''
+    Fits K-Means with k clusters on the sample in a worker process and scores the result
+    params: k(int) = number of clusters, scale(float) = dataset rows per sampled row, to report cluster sizes of the whole dataset
+    returns: (dict, KMeans) = k, seconds, inertia, sampled silhouette, mean and smallest estimated cluster size; and the fitted model
+    '''
+    start = time.perf_counter()
+    model = KMeans(n_clusters=k, random_state=42).fit(_worker_values)
+    sizes = np.bincount(model.labels_, minlength=k) * scale
+    silhouette = silhouette_score(_worker_values, model.labels_, sample_size=min(SILHOUETTE_SIZE, len(_worker_values)), random_state=42)
+    return {'k': k, 'seconds': time.perf_counter() - start, 'inertia': float(model.inertia_ * scale), 'silhouette': float(silhouette),
+            'mean_size': float(sizes.mean()), 'min_size': int(sizes.min())}, model
+
+
+def _elbow(ks, inertias):
+    '''
+    Elbow of the inertia curve: the k farthest below the straight line joining the first and last points
+    params: ks(list) = cluster counts in increasing order, inertias(list) = matching inertias
+    returns: int = k at the elbow
+    '''
+    if len(ks) < 3:
+        return ks[0]
+    x = (np.array(ks) - ks[0]) / (ks[-1] - ks[0])
+    y = (np.array(inertias) - inertias[-1]) / ((inertias[0] - inertias[-1]) or 1)
+    return ks[int(np.argmax((1 - x) - y))]
+
 
 class DataProcessor:
     def __init__(self, file_path):
@@ -16,20 +131,62 @@ class DataProcessor:
         self.file_path = file_path   # path to dataset
         self.data = None             # placeholder for loaded dataset
         self.cluster_model = None    # placeholder for k-means model
+        self.feature_stats = None    # per-feature mean and std used by preprocessData
+        self.artifact_key = None     # key of the artifact the data was loaded from or saved to
+        self.load_stats = None       # where the last loadData read from and how long it took
+        self.cluster_baseline = None # centroids, cluster sizes and inertia per song as of the last full clustering
+        self.k_selection = None      # per-k scores and timings from the last automatic cluster count selection, kept in the artifact manifest
         
-    def loadData(self):
+    @metrics.timed('stage_seconds', memory=True, stage='loadData')
+    def loadData(self, compact=False, engine=None, cache=False):
         '''
         Load dataset from csv into pandas data frame
+        params: compact(bool) = read only the required columns with float32 features and categorical artists,
+                engine(str) = pandas CSV parser, e.g. 'pyarrow' when it is installed,
+                cache(bool) = reuse a binary sidecar of the parsed data while the CSV is unchanged
         returns: pd.DataFrame = the loaded dataset
         '''
-        self.data = pd.read_csv(self.file_path)  
-        required_columns = ['id', 'name', 'artists', 'valence', 'danceability', 'energy', 'tempo', 'acousticness']
-        missing_columns = [col for col in required_columns if col not in self.data.columns]
+        start = time.perf_counter()
+        cache_path = f"{self.file_path}.{'compact' if compact else 'full'}.cache.pkl"
+        meta_path = f"{cache_path}.json"
+
+        meta = None
+        if cache and os.path.exists(cache_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        fingerprint = _sourceFingerprint(self.file_path, meta and meta['source']) if cache else None
+
+        if meta and meta['version'] == CACHE_VERSION and meta['source']['sha256'] == fingerprint['sha256']:
+            self.data = pd.read_pickle(cache_path)
+            source = 'cache'
+        else:
+            if compact:
+                header = pd.read_csv(self.file_path, nrows=0).columns   # validate before usecols would fail on a missing column
+                missing_columns = [col for col in REQUIRED_COLS if col not in header]
+                if missing_columns:
+                    raise ValueError(f"The dataset is missing required columns: {', '.join(missing_columns)}")
+                self.data = pd.read_csv(self.file_path, usecols=REQUIRED_COLS, dtype=COMPACT_DTYPES, engine=engine)[REQUIRED_COLS]
+            else:
+                self.data = pd.read_csv(self.file_path, engine=engine)
+            source = 'csv'
+
+        missing_columns = [col for col in REQUIRED_COLS if col not in self.data.columns]
 
         if missing_columns:
             raise ValueError(f"The dataset is missing required columns: {', '.join(missing_columns)}")
+
+        if cache and source == 'csv':
+            self.data.to_pickle(cache_path)
+            with open(meta_path, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'source': fingerprint}, f, indent=2)
+        elif cache and fingerprint != meta['source']:
+            with open(meta_path, 'w') as f:   # same content under a new mtime, record it so the next load skips hashing
+                json.dump({'version': CACHE_VERSION, 'source': fingerprint}, f, indent=2)
+
+        self.load_stats = {'source': source, 'seconds': time.perf_counter() - start}
         return self.data
     
+    @metrics.timed('stage_seconds', memory=True, stage='clean')
     def clean(self):
         '''
         Cleans dataset to handle missing values and duplicates
@@ -40,12 +197,12 @@ class DataProcessor:
         important = ['name', 'id', 'artists']              # important columns for analysis
         self.data = self.data.dropna(subset=important)            # drop rows with missing critical values
         
-        feature_cols = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
-        for col in feature_cols:
+        for col in FEATURE_COLS:
             if col in self.data.columns:
                 self.data[col] = self.data[col].fillna(self.data[col].mean())    # fills in missing values in feature columns with column mean
         
         
+    @metrics.timed('stage_seconds', memory=True, stage='preprocessData')
     def preprocessData(self):
         '''
         Normalizing relevant features for clustering and similarity calculations
@@ -54,26 +211,339 @@ class DataProcessor:
         '''
         
         # detect feature columns to normalize for similarity
-        feature_cols = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
-        features = [col for col in feature_cols if col in self.data.columns]
+        features = [col for col in FEATURE_COLS if col in self.data.columns]
+        self.feature_stats = {col: {'mean': float(self.data[col].mean()), 'std': float(self.data[col].std())} for col in features}
         
         # normalize each feature to have mean 0 and std 1.
         self.data[features] = self.data[features].apply(lambda x: x - x.mean() / x.std())
         return self.data
+
+    @metrics.timed('stage_seconds', memory=True, stage='streamProcess')
+    def streamProcess(self, output_path, chunksize=100_000):
+        '''
+        Chunked version of clean followed by preprocessData for datasets that don't fit in memory. The first pass
+        collects a 64-bit hash of every row, and one global sort of the hashes finds the first occurrence of each
+        row; the second pass accumulates per-feature mean and variance over the kept rows; the third re-reads the
+        CSV, fills and normalizes each chunk and appends it to output_path. Only the hashes (8 bytes per row) and
+        the row masks stay in memory. Non-feature columns are read as text, so duplicates are detected on the row text as written in the CSV
+        params: output_path(str) = CSV to write, chunksize(int) = rows per chunk
+        returns: dict = row counts of the run
+        '''
+        header = pd.read_csv(self.file_path, nrows=0).columns
+        missing_columns = [col for col in REQUIRED_COLS if col not in header]
+        if missing_columns:
+            raise ValueError(f"The dataset is missing required columns: {', '.join(missing_columns)}")
+
+        features = [col for col in FEATURE_COLS if col in header]
+        dtypes = {col: (np.float64 if col in features else str) for col in header}
+        important = ['name', 'id', 'artists']
+
+        # pass 1: hash every row and note the rows with all critical values
+        hashes, complete = [], []
+        for chunk in pd.read_csv(self.file_path, dtype=dtypes, chunksize=chunksize):
+            hashes.append(pd.util.hash_pandas_object(chunk, index=False).to_numpy())
+            complete.append(chunk[important].notna().all(axis=1).to_numpy())
+        sizes = [len(chunk_hashes) for chunk_hashes in hashes]
+        hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+        keep = np.zeros(len(hashes), dtype=bool)
+        keep[np.unique(hashes, return_index=True)[1]] = True   # first occurrence of every row, one sort for the whole file
+        rows_in = len(hashes)
+        del hashes
+        if complete:
+            keep &= np.concatenate(complete)                   # drop rows with missing critical values
+        rows_out = int(keep.sum())
+        keep_masks = [np.packbits(mask) for mask in np.split(keep, np.cumsum(sizes)[:-1])]
+        del keep, complete
+
+        # pass 2: merge per-chunk statistics of the kept rows (Chan et al. parallel form of Welford)
+        count, mean, m2 = np.zeros(len(features)), np.zeros(len(features)), np.zeros(len(features))
+        reader = pd.read_csv(self.file_path, dtype=dtypes, chunksize=chunksize)
+        for chunk, packed in zip(reader, keep_masks):
+            values = chunk.loc[np.unpackbits(packed, count=len(chunk)).astype(bool), features]
+            chunk_count = values.count().to_numpy(dtype=np.float64)
+            chunk_mean = np.nan_to_num(values.mean().to_numpy(dtype=np.float64))
+            chunk_m2 = ((values - chunk_mean) ** 2).sum().to_numpy(dtype=np.float64)
+            total = count + chunk_count
+            delta = chunk_mean - mean
+            safe_total = np.where(total > 0, total, 1)
+            mean = mean + delta * chunk_count / safe_total
+            m2 = m2 + chunk_m2 + delta ** 2 * count * chunk_count / safe_total
+            count = total
+
+        # filling missing values with the mean leaves the sum of squares unchanged and adds rows to the count
+        mean = np.where(count > 0, mean, np.nan)
+        std = np.sqrt(m2 / (rows_out - 1)) if rows_out > 1 else np.full(len(features), np.nan)
+        self.feature_stats = {col: {'mean': float(mean[i]), 'std': float(std[i])} for i, col in enumerate(features)}
+
+        # pass 3: fill, normalize and append each chunk
+        reader = pd.read_csv(self.file_path, dtype=dtypes, chunksize=chunksize)
+        for i, (chunk, packed) in enumerate(zip(reader, keep_masks)):
+            chunk = chunk[np.unpackbits(packed, count=len(chunk)).astype(bool)].copy()
+            for j, col in enumerate(features):
+                chunk[col] = chunk[col].fillna(mean[j]) - mean[j] / std[j]   # same expression as preprocessData
+            chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        if rows_in == 0:
+            pd.DataFrame(columns=header).to_csv(output_path, index=False)
+
+        return {'rows_in': rows_in, 'rows_out': rows_out}
         
-    def clusterData(self, n_clusters=10):
+    @metrics.timed('stage_seconds', memory=True, stage='clusterData')
+    def clusterData(self, n_clusters=10, mini_batch=False, k_range=range(2, 31), top=5, n_jobs=None, sample_size=10000):
         '''
         Cluster songs using K-Means and add cluster labels to dataset
-        params: n_clusters(int) = number of clusters
+        params: n_clusters(int or 'auto') = number of clusters, 'auto' picks it with selectClusterCount and keeps the winning
+                model fitted on the sample, which then labels every song,
+                mini_batch(bool) = fit with mini-batch K-Means, cheaper on large datasets,
+                k_range, top, n_jobs, sample_size = passed to selectClusterCount when n_clusters is 'auto'
         returns: pd.DataFrame = dataset with cluster labels added
         '''
         
-        feature_cols = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
-        features = [col for col in feature_cols if col in self.data.columns]
+        features = [col for col in FEATURE_COLS if col in self.data.columns]
         
         if not features:
             raise ValueError("No features available for clustering.")
         
-        self.cluster_model = KMeans(n_clusters=n_clusters, random_state=42)
-        self.data['cluster'] = self.cluster_model.fit_predict(self.data[features])
-        return self.data 
+        if n_clusters == 'auto':
+            _, self.cluster_model = self._selectClusterCount(k_range, top, n_jobs, sample_size)
+            self.data['cluster'] = self.cluster_model.predict(self.data[features])   # no second fit of the chosen k
+        else:
+            if mini_batch:
+                self.cluster_model = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, batch_size=4096, n_init=3)
+            else:
+                self.cluster_model = KMeans(n_clusters=n_clusters, random_state=42)
+            self.data['cluster'] = self.cluster_model.fit_predict(self.data[features])
+        self.cluster_baseline = self._clusterBaseline()
+        return self.data
+
+    def selectClusterCount(self, k_range=range(2, 31), top=5, n_jobs=None, sample_size=10000):
+        '''
+        Fits K-Means for every k in k_range on a random sample of songs across a process pool and picks the cluster
+        count. Only k values whose smallest cluster, scaled up to the whole dataset, still holds more than top songs
+        are considered, so recommend never needs its slow global fallback, and only k at or past the elbow of the
+        inertia curve, where clusters get smaller without much loss. Among those the best silhouette score, computed
+        on SILHOUETTE_SIZE songs of the sample, wins. Each step is relaxed if it leaves no candidate.
+        params: k_range(iterable) = cluster counts to try, top(int) = recommendations per query,
+                n_jobs(int) = worker processes (default: one per CPU), sample_size(int) = songs sampled to fit and score each k
+        returns: int = chosen number of clusters, with per-k scores and timings stored in self.k_selection
+        '''
+        return self._selectClusterCount(k_range, top, n_jobs, sample_size)[0]
+
+    @metrics.timed('stage_seconds', memory=True, stage='selectClusterCount')
+    def _selectClusterCount(self, k_range, top, n_jobs, sample_size):
+        '''
+        returns: (int, KMeans) = chosen number of clusters and its model fitted on the sample, see selectClusterCount
+        '''
+        features = [col for col in FEATURE_COLS if col in self.data.columns]
+        values = self.data[features].astype(np.float64)
+        if len(values) > sample_size:
+            values = values.iloc[np.sort(np.random.default_rng(42).choice(len(values), sample_size, replace=False))]
+        ks = sorted(k for k in k_range if 2 <= k < len(values))
+        if not ks:
+            raise ValueError("No cluster count in k_range fits the dataset.")
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_initWorker, initargs=(values,)) as pool:
+            fitted = list(pool.map(_evaluateK, ks, [len(self.data) / len(values)] * len(ks)))
+        results = [result for result, _ in fitted]
+
+        elbow = _elbow(ks, [result['inertia'] for result in results])
+        candidates = [r for r in results if r['min_size'] > top and r['k'] >= elbow] \
+            or [r for r in results if r['min_size'] > top] or results
+        chosen = max(candidates, key=lambda r: (r['silhouette'], r['k']))['k']
+        self.k_selection = {'chosen': chosen, 'elbow': elbow, 'top': top, 'sample_size': len(values),
+                            'seconds': time.perf_counter() - start, 'results': results}
+        return chosen, fitted[ks.index(chosen)][1]
+
+    def _clusterBaseline(self):
+        '''
+        Snapshot of the current clustering that incremental updates are measured against
+        returns: dict = centroids, cluster sizes and mean squared distance of a song to its centroid
+        '''
+        features = list(self.cluster_model.feature_names_in_)
+        values = self.data[features].to_numpy(dtype=np.float64)
+        labels = self.data['cluster'].to_numpy()
+        centers = self.cluster_model.cluster_centers_.astype(np.float64)
+        return {'centers': centers.copy(),
+                'counts': np.bincount(labels, minlength=len(centers)).astype(np.float64),
+                'inertia_per_song': float(((values - centers[labels]) ** 2).sum(axis=1).mean()),
+                'songs_added': 0}
+
+    @metrics.timed('stage_seconds', memory=True, stage='addTracks')
+    def addTracks(self, new_data, refit_threshold=0.25):
+        '''
+        Adds new songs without refitting: they are normalized with the stored statistics, assigned to the nearest
+        existing centroid, and each centroid moves to the running mean of its songs (the mini-batch K-Means update
+        with a 1/count learning rate). Songs whose id is already in the dataset are skipped.
+        The report says when the clusters have drifted enough that a full clusterData refit is worth it
+        params: new_data(pd.DataFrame) = new songs with the required columns, refit_threshold(float) = allowed relative
+                growth of inertia per song, and allowed centroid shift in units of the typical song-centroid distance
+        returns: dict = songs added, inertia per new song, baseline inertia, drift and whether to refit
+        '''
+        if self.cluster_model is None:
+            raise ValueError("The data must be clustered before tracks can be added.")
+        if self.cluster_baseline is None:
+            self.cluster_baseline = self._clusterBaseline()
+        features = list(self.cluster_model.feature_names_in_)
+        baseline = self.cluster_baseline
+
+        new_rows = new_data.drop_duplicates().dropna(subset=['name', 'id', 'artists'])
+        new_rows = new_rows[~new_rows['id'].isin(self.data['id'])].drop_duplicates(subset='id').copy()
+        if self.feature_stats is not None:   # same fill and normalization as clean and preprocessData
+            for col in features:
+                stats = self.feature_stats[col]
+                new_rows[col] = new_rows[col].fillna(stats['mean']) - stats['mean'] / stats['std']
+
+        inertia = 0.0
+        if len(new_rows):
+            values = new_rows[features].to_numpy(dtype=np.float64)
+            labels = self.cluster_model.predict(new_rows[features])
+            new_rows['cluster'] = labels
+
+            centers = self.cluster_model.cluster_centers_.astype(np.float64)
+            inertia = float(((values - centers[labels]) ** 2).sum(axis=1).mean())
+            added = np.bincount(labels, minlength=len(centers)).astype(np.float64)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, values)
+            counts = baseline['counts'] + added
+            moved = added > 0
+            centers[moved] += (sums[moved] - added[moved, None] * centers[moved]) / counts[moved, None]
+            self.cluster_model.cluster_centers_ = centers.astype(self.cluster_model.cluster_centers_.dtype)
+            baseline['counts'] = counts
+            baseline['songs_added'] += len(new_rows)
+
+            self.data = pd.concat([self.data, new_rows.reindex(columns=self.data.columns)], ignore_index=True)
+
+        scale = np.sqrt(baseline['inertia_per_song']) or 1
+        drift = float(np.linalg.norm(self.cluster_model.cluster_centers_ - baseline['centers'], axis=1).max() / scale)
+        inertia_ratio = inertia / baseline['inertia_per_song'] if baseline['inertia_per_song'] else 0.0
+        return {'songs_added': len(new_rows), 'songs_since_refit': baseline['songs_added'],
+                'inertia_per_song': inertia, 'baseline_inertia_per_song': baseline['inertia_per_song'],
+                'drift': drift, 'needs_refit': drift > refit_threshold or inertia_ratio > 1 + refit_threshold}
+
+    def _pipelineParams(self, n_clusters):
+        '''
+        Parameters that change the output of the pipeline, part of the artifact key
+        params: n_clusters(int) = number of clusters
+        returns: dict = pipeline parameters
+        '''
+        return {'version': ARTIFACT_VERSION, 'features': FEATURE_COLS, 'n_clusters': n_clusters, 'random_state': 42}
+
+    def _artifactKey(self, directory, n_clusters):
+        '''
+        Hash of the source CSV and the pipeline parameters. The CSV is only re-hashed when its size or
+        modification time differ from the last build recorded in latest.json
+        params: directory(str) = artifact directory, n_clusters(int) = number of clusters
+        returns: (str, dict) = artifact key and the source fingerprint it was computed from
+        '''
+        params = self._pipelineParams(n_clusters)
+
+        latest_path = os.path.join(directory, 'latest.json')
+        latest = None
+        if os.path.exists(latest_path):
+            with open(latest_path) as f:
+                latest = json.load(f)
+        source = _sourceFingerprint(self.file_path, latest['source'] if latest and latest['params'] == params else None)
+
+        key = hashlib.sha256(json.dumps({'source': source['sha256'], 'params': params}, sort_keys=True).encode()).hexdigest()[:16]
+        return key, source
+
+    @metrics.timed('stage_seconds', memory=True, stage='saveArtifact')
+    def saveArtifact(self, directory, n_clusters=10):
+        '''
+        Saves the clustered dataset, normalization statistics and K-Means model under a key derived from the
+        source CSV and pipeline parameters. Files are written to a temporary folder that is renamed into place
+        params: directory(str) = artifact directory, n_clusters(int) = number of clusters the data was clustered with
+        returns: str = artifact key
+        '''
+        if self.cluster_model is None:
+            raise ValueError("The data must be clustered before it can be saved.")
+        key, source = self._artifactKey(directory, n_clusters)
+        target = os.path.join(directory, key)
+        features = [col for col in FEATURE_COLS if col in self.data.columns]
+
+        if not os.path.exists(target):
+            staging = f"{target}.tmp-{os.getpid()}"
+            os.makedirs(staging, exist_ok=True)
+            np.save(os.path.join(staging, 'features.npy'), self.data[features].to_numpy(dtype=np.float64))
+            np.save(os.path.join(staging, 'labels.npy'), self.data['cluster'].to_numpy(dtype=np.int32))
+            np.save(os.path.join(staging, 'centroids.npy'), self.cluster_model.cluster_centers_)
+            for col in ['id', 'name', 'artists']:
+                data, offsets = _encodeStrings(self.data[col])
+                np.save(os.path.join(staging, f'{col}_bytes.npy'), data)
+                np.save(os.path.join(staging, f'{col}_offsets.npy'), offsets)
+            joblib.dump(self.cluster_model, os.path.join(staging, 'kmeans.joblib'))
+            with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+                json.dump({'version': ARTIFACT_VERSION, 'key': key, 'features': features,
+                           'feature_stats': self.feature_stats, 'rows': len(self.data), 'k_selection': self.k_selection}, f, indent=2)
+            try:
+                os.rename(staging, target)
+            except OSError:
+                shutil.rmtree(staging)   # another process saved the same artifact first
+
+        latest_tmp = os.path.join(directory, f'latest.json.tmp-{os.getpid()}')
+        with open(latest_tmp, 'w') as f:
+            json.dump({'key': key, 'source': source, 'params': self._pipelineParams(n_clusters)}, f, indent=2)
+        os.replace(latest_tmp, os.path.join(directory, 'latest.json'))
+        self.artifact_key = key
+        return key
+
+    @metrics.timed('stage_seconds', memory=True, stage='loadArtifact')
+    def loadArtifact(self, directory, n_clusters=10):
+        '''
+        Loads the artifact built from the current source CSV with the given parameters, if one exists
+        params: directory(str) = artifact directory, n_clusters(int) = number of clusters
+        returns: pd.DataFrame = clustered dataset, or None when the artifact is missing or out of date
+        '''
+        if self.loadModel(directory, n_clusters) is None:
+            return None
+        target = os.path.join(directory, self.artifact_key)
+        with open(os.path.join(target, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        data = pd.DataFrame({col: _decodeStrings(np.load(os.path.join(target, f'{col}_bytes.npy')), np.load(os.path.join(target, f'{col}_offsets.npy')))
+                             for col in ['id', 'name', 'artists']})
+        data[manifest['features']] = np.load(os.path.join(target, 'features.npy'))
+        data['cluster'] = np.load(os.path.join(target, 'labels.npy'))
+        self.data = data
+        return self.data
+
+    def loadModel(self, directory, n_clusters=10):
+        '''
+        Loads only the K-Means model, normalization statistics and cluster count selection of the artifact built
+        from the current source CSV, without reading the dataset itself
+        params: directory(str) = artifact directory, n_clusters(int) = number of clusters
+        returns: KMeans = the fitted model, or None when the artifact is missing or out of date
+        '''
+        if not os.path.isdir(directory):
+            return None
+        key, _ = self._artifactKey(directory, n_clusters)
+        target = os.path.join(directory, key)
+        manifest_path = os.path.join(target, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['version'] != ARTIFACT_VERSION:
+            return None
+
+        self.cluster_model = joblib.load(os.path.join(target, 'kmeans.joblib'))
+        self.feature_stats = manifest['feature_stats']
+        self.k_selection = manifest.get('k_selection')
+        self.artifact_key = key
+        return self.cluster_model
+
+    def loadOrBuild(self, directory, n_clusters=10):
+        '''
+        Loads the saved artifact for the current CSV, or runs the full pipeline and saves it when the CSV or parameters changed
+        params: directory(str) = artifact directory, n_clusters(int) = number of clusters
+        returns: pd.DataFrame = clustered dataset
+        '''
+        if self.loadArtifact(directory, n_clusters) is not None:
+            return self.data
+        self.loadData()
+        self.clean()
+        self.preprocessData()
+        self.clusterData(n_clusters=n_clusters)
+        os.makedirs(directory, exist_ok=True)
+        self.saveArtifact(directory, n_clusters)
+        return self.data
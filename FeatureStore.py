@@ -0,0 +1,240 @@
+# Description: This module defines the FeatureStore class, an on-disk, memory-mapped copy of the clustered dataset.
+# Every server worker maps the same files read-only, so the operating system keeps one shared copy in the page cache
+# and only the rows that end up in a response are turned into pandas objects. The features are stored once, with the
+# inverse row norms of every feature selection, and each selection is served as a masked view over them.
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from DataProcessor import FEATURE_COLS, _decodeStrings, _encodeStrings
+
+STORE_VERSION = 2
+
+
+def _subsetMask(store_features, features):
+    '''
+    Bitmask identifying a feature selection, independent of the order the features were picked in
+    params: store_features(list) = features held by the store, features(list) = selected features
+    returns: int = bitmask over store_features
+    '''
+    missing = [feature for feature in features if feature not in store_features]
+    if missing:
+        raise KeyError(f"Features not in the feature store: {', '.join(missing)}")
+    return sum(1 << store_features.index(feature) for feature in set(features))
+
+
+class _MaskedMatrix:
+    '''
+    Read-only view of a feature matrix restricted to a column mask, with every row scaled to unit length over the
+    selected columns. The inverse row norms of the selection are computed once, by the Recommender for a DataFrame and
+    by FeatureStore.build for a store, and scale rows as they are read, so one shared matrix serves every selection
+    '''
+    def __init__(self, matrix, columns, inverse_norms):
+        '''
+        params: matrix(np.ndarray) = n_songs x n_features shared matrix, columns(list) = positions of the selected columns,
+                inverse_norms(np.ndarray) = 1 / L2 norm of every row over the selected columns, see _inverseNorms
+        '''
+        self.matrix = matrix
+        self.columns = columns
+        self.inverse_norms = inverse_norms
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __getitem__(self, rows):
+        values = np.atleast_2d(self.matrix[rows])
+        normalized = values[:, self.columns] * np.atleast_1d(self.inverse_norms[rows])[:, None]
+        return normalized[0] if np.ndim(rows) == 0 and not isinstance(rows, slice) else normalized
+
+    def __matmul__(self, vector):
+        full = np.zeros(self.matrix.shape[1])   # spread the selected-column vector over the mask, no column copy of the matrix
+        full[self.columns] = vector
+        return (self.matrix @ full) * self.inverse_norms
+
+
+def _inverseNorms(matrix, columns):
+    '''
+    Inverse L2 norm of every row over the selected columns, zero rows get 1 so they stay zero
+    params: matrix(np.ndarray) = n_songs x n_features matrix, columns(list) = positions of the selected columns
+    returns: np.ndarray = read-only vector of n_songs factors
+    '''
+    mask = np.zeros(matrix.shape[1])
+    mask[columns] = 1
+    norms = np.sqrt(np.einsum('ij,ij,j->i', matrix, matrix, mask))
+    norms[norms == 0] = 1
+    inverse = 1 / norms
+    inverse.flags.writeable = False
+    return inverse
+
+
+class FeatureStore:
+    def __init__(self, directory):
+        '''
+        Opens a feature store written by FeatureStore.build. Every array is memory-mapped read-only here, so an open
+        store never maps a file of a later build
+        params: directory(str) = store directory
+        '''
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != STORE_VERSION:
+            raise ValueError(f"Feature store version {self.meta['version']} is not supported.")
+        self.features = self.meta['features']
+
+        self.labels = self._map('labels')                   # cluster label of every row
+        self.id_codes = self._map('id_codes')               # integer code per row, shared by rows with the same id
+        self.unique_ids = self._map('unique_ids')           # sorted distinct ids, the code is the position in here
+        self.first_rows = self._map('first_rows')           # code -> first row holding that id
+        self.cluster_order = self._map('cluster_order')     # row positions grouped by cluster label
+        self.cluster_labels = self._map('cluster_labels')
+        self.cluster_starts = self._map('cluster_starts')   # offsets of each label's group in cluster_order
+        self._ids = self._map('ids')
+        self._strings = {col: (self._map(f'{col}_bytes'), self._map(f'{col}_offsets')) for col in ['name', 'artists']}
+        self._features = self._map('features')              # n_songs x n_features, not normalized
+        self._inverse_norms = self._map('inverse_norms')    # row mask - 1 -> inverse row norms of that feature selection
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def _map(self, name):
+        return np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+
+    def matrix(self, features):
+        '''
+        L2-normalized matrix of the selected features, a masked view over the mapped feature array
+        params: features(list) = selected features
+        returns: _MaskedMatrix = n_songs x n_features read-only matrix
+        '''
+        mask = _subsetMask(self.features, features)
+        columns = [i for i in range(len(self.features)) if mask & (1 << i)]
+        return _MaskedMatrix(self._features, columns, self._inverse_norms[mask - 1])
+
+    def idCode(self, targetID):
+        '''
+        Binary search of the sorted id array
+        params: targetID(str) = song ID
+        returns: int = code of the id, or None if it is not in the store
+        '''
+        key = str(targetID).encode('utf-8')
+        code = int(np.searchsorted(self.unique_ids, key))
+        if code < len(self.unique_ids) and self.unique_ids[code] == key:
+            return code
+        return None
+
+    def clusterRows(self):
+        '''
+        Row positions grouped by cluster label, as views into the mapped cluster_order array
+        returns: dict = cluster label -> row positions
+        '''
+        return {label: self.cluster_order[self.cluster_starts[i]:self.cluster_starts[i + 1]]
+                for i, label in enumerate(self.cluster_labels.tolist())}
+
+    def frame(self, rows, columns):
+        '''
+        Materializes only the requested rows into pandas
+        params: rows(np.ndarray) = row positions, columns(list) = any of 'id', 'name', 'artists'
+        returns: pd.DataFrame = the rows, indexed by row position
+        '''
+        rows = np.asarray(rows, dtype=np.intp)
+        values = {}
+        for col in columns:
+            if col == 'id':
+                values[col] = [value.decode('utf-8') for value in self._ids[rows]]
+            else:
+                data, offsets = self._strings[col]
+                values[col] = [bytes(data[offsets[row]:offsets[row + 1]]).decode('utf-8') for row in rows]
+        return pd.DataFrame(values, index=rows)
+
+    def strings(self, col):
+        '''
+        Decodes a whole string column, for building derived indexes
+        params: col(str) = 'name' or 'artists'
+        returns: list = the values in row order
+        '''
+        return _decodeStrings(*self._strings[col])
+
+    @staticmethod
+    def build(directory, data, features=None):
+        '''
+        Writes the store for a clustered dataset: the features with the inverse row norms of every feature selection,
+        cluster labels, the id index and the name/artist strings. Files are written next to the target and moved into
+        place; a current store already in the directory is never replaced, so open stores keep seeing the same files
+        params: directory(str) = store directory, data(pd.DataFrame) = clustered dataset, features(list) = features to store
+        returns: FeatureStore = the opened store
+        '''
+        features = [col for col in (features or FEATURE_COLS) if col in data.columns]
+        staging = f"{directory}.tmp-{os.getpid()}"
+        os.makedirs(staging, exist_ok=True)
+
+        def save(name, array):
+            np.save(os.path.join(staging, f'{name}.npy'), array)
+
+        # the features once, plus one vector of inverse row norms per non-empty feature selection
+        values = np.ascontiguousarray(data[features].to_numpy(dtype=np.float32))
+        save('features', values)
+        inverse_norms = np.empty((max((1 << len(features)) - 1, 0), len(values)), dtype=np.float32)
+        for mask in range(1, 1 << len(features)):
+            inverse_norms[mask - 1] = _inverseNorms(values, [i for i in range(len(features)) if mask & (1 << i)])
+        save('inverse_norms', inverse_norms)
+
+        labels = data['cluster'].to_numpy(dtype=np.int32)
+        order = np.argsort(labels, kind='stable')
+        cluster_labels, starts = np.unique(labels[order], return_index=True)
+        save('labels', labels)
+        save('cluster_order', order)
+        save('cluster_labels', cluster_labels)
+        save('cluster_starts', np.append(starts, len(labels)))
+
+        ids = np.array([str(value).encode('utf-8') for value in data['id']], dtype=bytes)
+        unique_ids, first_rows, codes = np.unique(ids, return_index=True, return_inverse=True)
+        save('ids', ids)
+        save('unique_ids', unique_ids)
+        save('first_rows', first_rows)
+        save('id_codes', codes.astype(np.int64))
+
+        for col in ['name', 'artists']:
+            buffer, offsets = _encodeStrings(data[col])
+            save(f'{col}_bytes', buffer)
+            save(f'{col}_offsets', offsets)
+
+        with open(os.path.join(staging, 'meta.json'), 'w') as f:
+            json.dump({'version': STORE_VERSION, 'features': features, 'rows': len(data)}, f, indent=2)
+
+        if os.path.exists(directory) and not FeatureStore.isCurrent(directory):
+            retired = f"{directory}.old-{os.getpid()}"
+            try:
+                os.rename(directory, retired)   # an outdated layout nobody can open, moved aside before it is deleted
+                shutil.rmtree(retired)
+            except OSError:
+                pass
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            shutil.rmtree(staging)   # another worker built the same store first, keep serving its files
+        return FeatureStore(directory)
+
+    @staticmethod
+    def isCurrent(directory):
+        '''
+        returns: bool = whether directory holds a complete store of the current version
+        '''
+        try:
+            with open(os.path.join(directory, 'meta.json')) as f:
+                return json.load(f)['version'] == STORE_VERSION
+        except (OSError, ValueError, KeyError):
+            return False
+
+    @staticmethod
+    def openOrBuild(directory, data):
+        '''
+        Opens the store in directory, building it from data first if it does not exist yet
+        params: directory(str) = store directory, data(pd.DataFrame) = clustered dataset
+        returns: FeatureStore = the opened store
+        '''
+        if FeatureStore.isCurrent(directory):
+            return FeatureStore(directory)
+        return FeatureStore.build(directory, data)
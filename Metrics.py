@@ -0,0 +1,171 @@
+# Description: This module defines the Metrics registry used to instrument the pipeline stages, the phases of a
+# recommendation and the dashboard callbacks. It keeps latency histograms and memory deltas, renders them in the
+# Prometheus text format for the /metrics endpoint and can dump a cProfile of slow requests. When disabled, timers are
+# a shared no-op context manager and timed functions are called straight through.
+
+import bisect
+import contextlib
+import cProfile
+import functools
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NULL_TIMER = contextlib.nullcontext()
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _currentRss():
+    '''
+    returns: int = resident memory of the process in bytes, or None where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _labelText(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in pairs) + '}'
+
+
+class Metrics:
+    def __init__(self, enabled=False, prefix='spotify', buckets=DEFAULT_BUCKETS, profile_dir=None, slow_threshold=0.5):
+        '''
+        params: enabled(bool) = collect measurements, prefix(str) = prepended to every metric name,
+                buckets(tuple) = histogram upper bounds in seconds, profile_dir(str) = where cProfile dumps of slow requests go, None to never profile,
+                slow_threshold(float) = seconds after which a profiled request is dumped
+        '''
+        self.enabled = enabled
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.profile_dir = profile_dir
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._histograms = {}   # (metric, labels) -> [bucket counts, sum, count]
+        self._memory = {}       # (metric, labels) -> last memory delta in bytes
+
+    def observe(self, metric, seconds, memory_delta=None, **labels):
+        '''
+        Records one measurement
+        params: metric(str) = histogram name without prefix, seconds(float) = duration, memory_delta(int) = change of resident memory in bytes,
+                labels = label values of the measurement
+        '''
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            if memory_delta is not None:
+                self._memory[key] = memory_delta
+
+    @contextlib.contextmanager
+    def _timer(self, metric, memory, labels):
+        rss = _currentRss() if memory else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            delta = _currentRss() - rss if rss is not None else None
+            self.observe(metric, elapsed, delta, **labels)
+
+    def timer(self, metric, memory=False, **labels):
+        '''
+        Times the body of a with statement
+        params: metric(str) = histogram name, memory(bool) = also record the change of resident memory, labels = label values
+        returns: context manager
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(metric, memory, labels)
+
+    def timed(self, metric, memory=False, profile=False, **labels):
+        '''
+        Decorator timing every call of a function, see timer
+        params: profile(bool) = run the call under cProfile when profile_dir is set and dump it if it took longer than slow_threshold
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                if profile and self.profile_dir:
+                    return self._profiled(function, args, kwargs, metric, memory, labels)
+                with self._timer(metric, memory, labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _profiled(self, function, args, kwargs, metric, memory, labels):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:   # another profiler is active in this process, run the call unprofiled
+            profiler = None
+        start = time.perf_counter()
+        try:
+            with self._timer(metric, memory, labels):
+                return function(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                if time.perf_counter() - start >= self.slow_threshold:
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                    name = '-'.join([metric] + [str(value) for _, value in sorted(labels.items())])
+                    profiler.dump_stats(os.path.join(self.profile_dir, f'{name}-{time.time_ns()}.prof'))
+
+    def reset(self):
+        '''
+        Drops every measurement
+        '''
+        with self._lock:
+            self._histograms.clear()
+            self._memory.clear()
+
+    def exposition(self):
+        '''
+        Renders every histogram and memory delta in the Prometheus text format
+        returns: str = body for the /metrics endpoint
+        '''
+        with self._lock:
+            histograms = {key: (list(counts), total, count) for key, (counts, total, count) in self._histograms.items()}
+            memory = dict(self._memory)
+
+        lines = []
+        for metric in sorted({metric for metric, _ in histograms}):
+            name = f'{self.prefix}_{metric}'
+            lines.append(f'# TYPE {name} histogram')
+            for (family, labels), (counts, total, count) in sorted(histograms.items()):
+                if family != metric:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{_labelText(labels, ("le", repr(bound)))} {cumulative}')
+                lines.append(f'{name}_bucket{_labelText(labels, ("le", "+Inf"))} {count}')
+                lines.append(f'{name}_sum{_labelText(labels)} {total}')
+                lines.append(f'{name}_count{_labelText(labels)} {count}')
+        for metric in sorted({metric for metric, _ in memory}):
+            name = f"{self.prefix}_{metric.removesuffix('_seconds')}_memory_delta_bytes"
+            lines.append(f'# TYPE {name} gauge')
+            for (family, labels), delta in sorted(memory.items()):
+                if family == metric:
+                    lines.append(f'{name}{_labelText(labels)} {delta}')
+        return '\n'.join(lines) + '\n'
+
+
+# shared registry, switched on with SPOTIFY_METRICS=1; SPOTIFY_PROFILE_DIR enables dumps of requests slower than SPOTIFY_SLOW_SECONDS
+metrics = Metrics(enabled=os.environ.get('SPOTIFY_METRICS') == '1', profile_dir=os.environ.get('SPOTIFY_PROFILE_DIR'),
+                  slow_threshold=float(os.environ.get('SPOTIFY_SLOW_SECONDS', '0.5')))
@@ -0,0 +1,149 @@
+# Description: This module defines the MicroBatcher class behind the JSON recommendation endpoint. Concurrent requests
+# are queued, and a single worker thread collects them for a few milliseconds and answers each group that shares a
+# feature selection with one Recommender.recommend_many call, a single matrix product for the whole group.
+
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+
+def _bucket(value):
+    '''
+    Upper bound of the power-of-two histogram bucket holding value
+    '''
+    bound = 1
+    while bound < value:
+        bound *= 2
+    return bound
+
+
+class MicroBatcher:
+    def __init__(self, recommender, max_batch=64, max_wait=0.005):
+        '''
+        Starts the batching worker thread
+        params: recommender(Recommender or callable) = recommender answering the batches, or a function returning the current one, max_batch(int) = most requests per batch,
+                max_wait(float) = seconds the first request of a batch waits for others to join
+        '''
+        self.recommender = recommender
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()     # bucket -> number of batches
+        self._queue_depths = Counter()    # bucket -> number of batches that started with that many requests waiting
+        self._max_depth = 0
+        self._requests = 0
+        self._running = True
+        self._worker = threading.Thread(target=self._run, name='recommend-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, targetID, features, top=5, cluster_priority=True):
+        '''
+        Queues one recommendation request
+        params: targetID(str) = ID of target song, features(list) = features to consider, top(int) = number of recommendations,
+                cluster_priority(bool) = prefer songs in the target's cluster
+        returns: Future = resolves to a list of recommendation dicts, or raises IndexError for an unknown song
+        '''
+        future = Future()
+        self._queue.put((targetID, list(features), top, bool(cluster_priority), future))
+        return future
+
+    def recommend(self, targetID, features, top=5, cluster_priority=True, timeout=None):
+        '''
+        Queues a request and waits for its answer
+        params: timeout(float) = seconds to wait, None to wait forever
+        returns: list = recommendation dicts with id, name, artists, similarity and cluster
+        '''
+        return self.submit(targetID, features, top, cluster_priority).result(timeout)
+
+    def _run(self):
+        while self._running:
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            depth = self._queue.qsize() + 1
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._process(batch, depth)
+            except Exception as error:   # nothing may stop the worker, otherwise every later request would hang
+                for item in batch:
+                    if not item[4].done():
+                        item[4].set_exception(error)
+
+    def _process(self, batch, depth):
+        '''
+        Records the batch in the histograms and answers it, one recommend_many call per feature selection
+        '''
+        with self._lock:
+            self._requests += len(batch)
+            self._batch_sizes[_bucket(len(batch))] += 1
+            self._queue_depths[_bucket(depth)] += 1
+            self._max_depth = max(self._max_depth, depth)
+
+        recommender = self.recommender() if callable(self.recommender) else self.recommender
+        groups = {}
+        for item in batch:
+            targetID, features, top, cluster_priority, future = item
+            try:
+                groups.setdefault((tuple(sorted(set(features))), cluster_priority), []).append(item)
+            except Exception as error:   # unhashable or unsortable features fail only this request
+                future.set_exception(error)
+        for (features, cluster_priority), items in groups.items():
+            self._answer(recommender, list(features), cluster_priority, items)
+
+    def _answer(self, recommender, features, cluster_priority, items):
+        '''
+        Answers every request of a group with one recommend_many call at the largest requested top
+        '''
+        valid = []
+        for item in items:
+            try:
+                recommender._locate(item[0])
+                valid.append(item)
+            except Exception as error:   # unknown or malformed ids fail only their own request
+                item[4].set_exception(error)
+        if not valid:
+            return
+        try:
+            seeds = list(dict.fromkeys(item[0] for item in valid))
+            top = max(item[2] for item in valid)
+            recs = recommender.recommend_many(seeds, features, top=top, cluster_priority=cluster_priority)
+            recs['similarity'] = recs['similarity'].round(2)
+            by_seed = {seed: rows.drop(columns=['seed_id', 'rank']).to_dict('records') for seed, rows in recs.groupby('seed_id', sort=False)}
+            for targetID, _, top, _, future in valid:
+                future.set_result(by_seed.get(targetID, [])[:top])
+        except Exception as error:
+            for item in valid:
+                if not item[4].done():
+                    item[4].set_exception(error)
+
+    def stats(self):
+        '''
+        Queue depth and batch size histograms, with power-of-two bucket upper bounds as keys
+        returns: dict = current and largest queue depth, request and batch counts, histograms
+        '''
+        with self._lock:
+            return {'queue_depth': self._queue.qsize(), 'max_queue_depth': self._max_depth, 'requests': self._requests,
+                    'batches': sum(self._batch_sizes.values()),
+                    'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                    'queue_depth_histogram': dict(sorted(self._queue_depths.items()))}
+
+    def close(self):
+        '''
+        Stops the worker thread once it finishes the current batch
+        '''
+        self._running = False
+        self._worker.join()
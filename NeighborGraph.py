@@ -0,0 +1,161 @@
+# Description: This module defines the NeighborGraph class, an offline precomputed table of the top-k most similar
+# songs for every song under one feature selection. Building it splits the catalog into row blocks that worker
+# processes score against the whole normalized matrix, read from shared memory; serving it is a single row lookup.
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from Recommender import _blockTopK
+
+GRAPH_VERSION = 1
+
+_shared = {}   # arrays attached from shared memory in each worker process, filled by _attach
+
+
+def _attach(specs):
+    '''
+    Worker initializer: maps the shared blocks created by NeighborGraph.build
+    params: specs(dict) = array name -> (shared memory name, shape, dtype), or None for a missing array
+    '''
+    for key, spec in specs.items():
+        if spec is None:
+            _shared[key] = None
+            continue
+        name, shape, dtype = spec
+        block = SharedMemory(name=name)
+        _shared[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        _shared[f'{key}_block'] = block   # keep the mapping alive as long as the worker
+
+
+def _graphBlock(start, end, k, catalog_block):
+    '''
+    Top-k neighbours of rows start..end against the whole shared matrix
+    returns: (int, np.ndarray, np.ndarray) = start row, neighbour rows and similarity percentages
+    '''
+    rows = np.arange(start, end)
+    codes = _shared['codes']
+    neighbors, scores = _blockTopK(_shared['matrix'], rows, codes[start:end], codes, _shared['labels'], k, catalog_block)
+    return start, neighbors, scores
+
+
+class NeighborGraph:
+    def __init__(self, directory):
+        '''
+        Opens a neighbour table written by NeighborGraph.build, memory-mapped read-only
+        params: directory(str) = graph directory
+        '''
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != GRAPH_VERSION:
+            raise ValueError(f"Neighbour graph version {self.meta['version']} is not supported.")
+        self.neighbors = np.load(os.path.join(directory, 'neighbors.npy'), mmap_mode='r')   # int32 rows, -1 pads
+        self.scores = np.load(os.path.join(directory, 'scores.npy'), mmap_mode='r')         # float16 cosine similarity
+
+    def matches(self, features, top, cluster_priority):
+        '''
+        Whether this table can answer a request
+        params: features(list) = selected features, top(int) = number of recommendations, cluster_priority(bool) = cluster filter in effect
+        returns: bool
+        '''
+        return (set(features) == set(self.meta['features']) and top <= self.meta['k']
+                and bool(cluster_priority) == self.meta['cluster_priority'])
+
+    def lookup(self, row, top):
+        '''
+        Precomputed neighbours of one song
+        params: row(int) = row position of the song, top(int) = number of neighbours
+        returns: (np.ndarray, np.ndarray) = neighbour rows and similarity percentages, best first
+        '''
+        rows = self.neighbors[row, :top]
+        valid = rows >= 0
+        return rows[valid].astype(np.intp), self.scores[row, :top][valid].astype(np.float64) * 100
+
+    @staticmethod
+    def build(directory, recommender, features, k=20, cluster_priority=True, n_jobs=None, block_size=256, catalog_block=32768):
+        '''
+        Computes the top-k neighbours of every song across a process pool and writes them as an int32 index table
+        and a float16 score table. The normalized matrix, id codes and cluster labels are copied once into shared
+        memory that every worker maps, instead of being pickled to each task
+        params: directory(str) = output directory, recommender(Recommender) = recommender over the dataset,
+                features(list) = feature selection, k(int) = neighbours per song, cluster_priority(bool) = rank same-cluster songs first,
+                n_jobs(int) = worker processes, block_size(int) = songs per task, catalog_block(int) = songs per scoring tile
+        returns: NeighborGraph = the opened table
+        '''
+        recommender._prepare()
+        matrix = recommender._featureMatrix(features)
+        codes = recommender._id_codes
+        labels = recommender._labels() if cluster_priority else None
+        n = len(matrix)
+        width = matrix[0:1].shape[1] if n else 0
+
+        blocks, specs = [], {}
+        try:
+            def share(key, source, shape, dtype):
+                block = SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+                blocks.append(block)
+                array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                for start in range(0, n, 65536):   # copied in slices so a masked view is never normalized all at once
+                    array[start:start + 65536] = source[start:start + 65536]
+                specs[key] = (block.name, shape, dtype)
+
+            share('matrix', matrix, (n, width), np.float64)
+            share('codes', codes, (n,), np.int64)
+            if labels is not None:
+                share('labels', labels, (n,), np.int64)
+            else:
+                specs['labels'] = None
+
+            staging = f"{directory}.tmp-{os.getpid()}"
+            os.makedirs(staging, exist_ok=True)
+            neighbors = np.lib.format.open_memmap(os.path.join(staging, 'neighbors.npy'), mode='w+', dtype=np.int32, shape=(n, k))
+            scores = np.lib.format.open_memmap(os.path.join(staging, 'scores.npy'), mode='w+', dtype=np.float16, shape=(n, k))
+            neighbors[:] = -1
+            scores[:] = 0
+
+            starts = list(range(0, n, block_size))
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach, initargs=(specs,)) as pool:
+                for start, rows, similarity in pool.map(_graphBlock, starts, [min(s + block_size, n) for s in starts],
+                                                        [k] * len(starts), [catalog_block] * len(starts)):
+                    valid = np.isfinite(similarity)
+                    end = start + len(rows)
+                    neighbors[start:end, :rows.shape[1]] = np.where(valid, rows, -1)
+                    scores[start:end, :rows.shape[1]] = np.where(valid, similarity / 100, 0)
+            neighbors.flush()
+            scores.flush()
+            del neighbors, scores
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        with open(os.path.join(staging, 'meta.json'), 'w') as f:
+            json.dump({'version': GRAPH_VERSION, 'features': sorted(features), 'k': k, 'rows': n,
+                       'cluster_priority': labels is not None}, f, indent=2)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(staging, directory)
+        return NeighborGraph(directory)
+
+
+if __name__ == "__main__":
+    from DataProcessor import DataProcessor
+    from Recommender import Recommender
+
+    parser = argparse.ArgumentParser(description="Precompute the neighbour table for a feature selection.")
+    parser.add_argument('--data', default='data.csv')
+    parser.add_argument('--features', nargs='+', default=['valence', 'danceability', 'energy'])  # dashboard default selection
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--clusters', default=os.environ.get('SPOTIFY_CLUSTERS', '10'), help="same cluster count as the server, or 'auto'")
+    args = parser.parse_args()
+
+    processor = DataProcessor(args.data)
+    clustered = processor.loadOrBuild("artifacts", n_clusters=args.clusters if args.clusters == 'auto' else int(args.clusters))
+    NeighborGraph.build(os.path.join("artifacts", processor.artifact_key, "neighbors-" + "-".join(sorted(args.features))),
+                        Recommender(clustered, processor.cluster_model), args.features, k=args.k, n_jobs=args.jobs)
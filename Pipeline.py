@@ -0,0 +1,170 @@
+# Description: This module defines the Pipeline class that builds the recommender in a background thread so the server
+# can start immediately. It watches the dataset for changes, rebuilds a complete Snapshot off the request path and swaps
+# it in with a single reference assignment, so requests already holding the old snapshot finish on it undisturbed.
+
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+from DataProcessor import DataProcessor, FEATURE_COLS
+from FeatureStore import FeatureStore
+from Metrics import metrics
+from NeighborGraph import NeighborGraph
+from Recommender import Recommender
+from SearchIndex import SearchIndex
+
+
+class Snapshot:
+    def __init__(self, recommender, data, version=1, artifact_key=None, build_seconds=None):
+        '''
+        Everything a request needs, built together and never modified afterwards. Only the recommender and the search
+        index keep a reference to the data, so a FeatureStore snapshot holds no pandas copy of the catalog
+        params: recommender(Recommender) = recommender over the dataset, data(FeatureStore or pd.DataFrame) = clustered dataset,
+                version(int) = increases with every reload, artifact_key(str) = artifact the snapshot was loaded from,
+                build_seconds(float) = time the build took
+        '''
+        self.recommender = recommender
+        self.features = data.features if isinstance(data, FeatureStore) else [col for col in FEATURE_COLS if col in data.columns]
+        self.search_index = SearchIndex(data)
+        self.version = version
+        self.artifact_key = artifact_key
+        self.build_seconds = build_seconds
+        self.loaded_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def _signature(path):
+    '''
+    returns: tuple = modification time and size of the file, None if it does not exist
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Pipeline:
+    def __init__(self, file_path, directory='artifacts', n_clusters=10, poll_interval=5.0):
+        '''
+        params: file_path(str) = dataset CSV to watch, directory(str) = artifact directory,
+                n_clusters(int or 'auto') = passed to DataProcessor.loadOrBuild, poll_interval(float) = seconds between checks of the CSV
+        '''
+        self.file_path = file_path
+        self.directory = directory
+        self.n_clusters = n_clusters
+        self.poll_interval = poll_interval
+        self.snapshot = None          # current Snapshot, replaced whole on every reload
+        self.building = False
+        self.last_error = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def build(self, version):
+        '''
+        Runs the pipeline for the current CSV, reusing saved artifacts when nothing changed. When the feature store
+        of the current artifact exists, only the K-Means model is read and the dataset is never loaded into pandas
+        params: version(int) = version number of the new snapshot
+        returns: Snapshot = the new snapshot
+        '''
+        start = time.perf_counter()
+        processor = DataProcessor(self.file_path)
+        store_dir = None
+        if processor.loadModel(self.directory, n_clusters=self.n_clusters) is not None:
+            store_dir = os.path.join(self.directory, processor.artifact_key, "store")
+        if store_dir is not None and FeatureStore.isCurrent(store_dir):
+            store = FeatureStore(store_dir)
+        else:
+            clustered = processor.loadOrBuild(self.directory, n_clusters=self.n_clusters)
+            store = FeatureStore.build(os.path.join(self.directory, processor.artifact_key, "store"), clustered)
+            processor.data = clustered = None   # the memory-mapped store replaces the frame
+        artifact_dir = os.path.join(self.directory, processor.artifact_key)
+
+        recommender = Recommender(store, processor.cluster_model)
+        # neighbour tables precomputed offline with `python NeighborGraph.py --features ...`
+        for name in sorted(os.listdir(artifact_dir)):
+            if name.startswith("neighbors-") and os.path.exists(os.path.join(artifact_dir, name, "meta.json")):
+                recommender.attachNeighbors(NeighborGraph(os.path.join(artifact_dir, name)))
+        snapshot = Snapshot(recommender, store, version, processor.artifact_key)
+        snapshot.build_seconds = time.perf_counter() - start   # includes opening or building the search index
+        return snapshot
+
+    def reload(self):
+        '''
+        Builds a new snapshot and swaps it in. A failed build keeps serving the previous snapshot. After a swap,
+        artifacts older than the previous snapshot's are deleted
+        returns: bool = whether a new snapshot was swapped in
+        '''
+        self.building = True
+        try:
+            with metrics.timer('reload_seconds'):
+                snapshot = self.build(self.snapshot.version + 1 if self.snapshot else 1)
+        except Exception as error:
+            self.last_error = f"{type(error).__name__}: {error}"
+            return False
+        finally:
+            self.building = False
+        previous, self.snapshot = self.snapshot, snapshot   # single assignment, readers see the old or the new snapshot
+        self.last_error = None
+        self._ready.set()
+        self._prune({snapshot.artifact_key, previous.artifact_key if previous else None})
+        return True
+
+    def _prune(self, keep):
+        '''
+        Deletes every artifact directory except the given keys, the previous snapshot's artifact is kept for the
+        requests still running on it
+        params: keep(set) = artifact keys to keep
+        '''
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name not in keep and os.path.exists(os.path.join(path, 'manifest.json')):
+                shutil.rmtree(path, ignore_errors=True)   # files still open on Windows are retried after the next swap
+
+    def _watch(self):
+        built = _signature(self.file_path)
+        self.reload()
+        previous = built
+        while not self._stop.wait(self.poll_interval):
+            current = _signature(self.file_path)
+            # rebuild once the file changed and then stayed the same for a whole interval, so half-written files are skipped
+            if current is not None and current != built and current == previous:
+                built = current
+                self.reload()
+            previous = current
+
+    def start(self):
+        '''
+        Starts the build and the file watcher in a background thread and returns immediately
+        '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='pipeline-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops watching the CSV, waiting for a build in progress to finish
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def waitReady(self, timeout=None):
+        '''
+        Blocks until the first snapshot is served
+        returns: bool = whether a snapshot is ready
+        '''
+        return self._ready.wait(timeout)
+
+    def status(self):
+        '''
+        returns: dict = readiness, snapshot version, artifact key, last build duration and error, whether a build is running
+        '''
+        snapshot = self.snapshot
+        return {'ready': snapshot is not None, 'version': snapshot.version if snapshot else None,
+                'artifact_key': snapshot.artifact_key if snapshot else None,
+                'loaded_at': snapshot.loaded_at if snapshot else None,
+                'last_reload_seconds': round(snapshot.build_seconds, 3) if snapshot else None,
+                'building': self.building, 'last_error': self.last_error}
@@ -2,106 +2,535 @@
 # Date: December 10, 2024
 # Description: This module defines the Recommender class that manages the recommendation logic using K-Means clustering and cosine similarity.
 
-import numpy as np 
+import threading
+
+import numpy as np
 import pandas as pd
 
+from DataProcessor import FEATURE_COLS
+from FeatureStore import FeatureStore, _MaskedMatrix, _inverseNorms
+from Metrics import metrics
+from ResultCache import ResultCache
+
+
+def _topK(scores, k):
+    '''
+    Picks the positions of the k highest scores, best first. argpartition does the selection so only k values get sorted
+    params: scores(np.ndarray) = similarity scores, k(int) = number of positions to return
+    returns: np.ndarray = positions into scores
+    '''
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def _topKRows(scores, k):
+    '''
+    Row-wise version of _topK for a 2-D block of scores
+    params: scores(np.ndarray) = n_seeds x n_songs similarity scores, k(int) = number of positions to return per row
+    returns: np.ndarray = n_seeds x k positions into each row of scores, best first
+    '''
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        best = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1)
+
+
+# added to same-cluster scores in batch ranking so they always outrank the global fallback (similarity is within +-100)
+_CLUSTER_BONUS = 1000.0
+
+
+def _blockTopK(matrix, rows, row_codes, codes, labels, top, catalog_block):
+    '''
+    Top matches for a block of seed songs, scored one catalog tile at a time with a matrix product and merged into
+    a running top-k per seed. Same-cluster songs rank first when labels are given, excluded songs score -inf
+    params: matrix = normalized feature matrix, rows(np.ndarray) = seed rows, row_codes(np.ndarray) = id codes of the seeds,
+            codes(np.ndarray) = id code of every row, labels(np.ndarray) = cluster labels or None, top(int) = matches per seed,
+            catalog_block(int) = songs per tile
+    returns: (np.ndarray, np.ndarray) = n_seeds x top row positions and similarity percentages, best first
+    '''
+    seeds = matrix[rows]
+    best_rows = np.empty((len(rows), 0), dtype=np.intp)
+    best_rank = np.empty((len(rows), 0))
+
+    for tile_start in range(0, len(matrix), catalog_block):
+        tile_end = min(tile_start + catalog_block, len(matrix))
+        rank = (seeds @ matrix[tile_start:tile_end].T) * 100
+        if labels is not None:
+            rank[labels[rows][:, None] == labels[tile_start:tile_end]] += _CLUSTER_BONUS
+        rank[row_codes[:, None] == codes[tile_start:tile_end]] = -np.inf  # exclude target songs
+
+        tile_best = _topKRows(rank, top)
+        merged_rows = np.hstack([best_rows, tile_best + tile_start])
+        merged_rank = np.hstack([best_rank, np.take_along_axis(rank, tile_best, axis=1)])
+        keep = _topKRows(merged_rank, top)
+        best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+        best_rank = np.take_along_axis(merged_rank, keep, axis=1)
+
+    if labels is not None:
+        best_rank = best_rank - _CLUSTER_BONUS * (labels[best_rows] == labels[rows][:, None])
+    return best_rows, best_rank
+
+
 class Recommender:
-    def __init__(self, data):
+    def __init__(self, data, cluster_model=None, cache_size=4096, cache_ttl=None, matrix_cache_size=0):
         '''
         Constructor initializes recommender with preprocessed data
-        params: data(pd.DataFrame) = dataset with normalized features
+        params: data(pd.DataFrame or FeatureStore) = dataset with normalized features, cluster_model(KMeans) = fitted model behind the 'cluster' column,
+                cache_size(int) = memoized recommend results, cache_ttl(float) = seconds a memoized result stays valid,
+                matrix_cache_size(int) = normalized feature matrices kept for a DataFrame, one per feature selection. Off by default,
+                the masked view needs no copy; set it to 31 to materialize every selection of the five features once
         '''
+        self.cache = ResultCache(cache_size, cache_ttl)           # (id, features, top, cluster priority, n_probe) -> recommendations
+        self._matrix_cache = ResultCache(matrix_cache_size)       # feature selection -> normalized matrix
+        self.cluster_model = cluster_model  # centroids for cluster-probed search
         self.data = data  #dataset for recommendations
-        
+
+    @property
+    def cluster_model(self):
+        return self._cluster_model
+
+    @cluster_model.setter
+    def cluster_model(self, cluster_model):
+        '''
+        A new cluster model invalidates the memoized results and centroids
+        params: cluster_model(KMeans) = fitted model behind the 'cluster' column
+        '''
+        self._cluster_model = cluster_model
+        self._centroids = {}
+        self.cache.clear()
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        '''
+        Replacing the dataset drops every precomputed structure, they are rebuilt lazily on the next query
+        params: data(pd.DataFrame or FeatureStore) = dataset with normalized features
+        '''
+        self._data = data
+        self._store = data if isinstance(data, FeatureStore) else None   # memory-mapped data shared between processes
+        self.cache.clear()
+        self._matrix_cache.clear()
+        self._lock = threading.Lock()
+        self._id_index = None        # id -> integer code, shared by rows with the same id
+        self._id_codes = None        # integer code of every row
+        self._first_rows = None      # code -> first row holding that id
+        self._cluster_rows = None    # cluster label -> row positions
+        self._label_array = None     # cluster label of every row
+        self._matrix = None          # read-only matrix of every feature column, shared by all requests
+        self._columns = None         # feature name -> column of _matrix
+        self._inverse_norms = {}     # tuple of features -> inverse row norms of _matrix over those columns
+        self._centroids = {}         # tuple of features -> cluster labels and normalized centroids
+        self._graphs = []            # precomputed neighbour tables, see attachNeighbors
+
+    def _prepare(self):
+        '''
+        Builds the id -> row hash index, the cluster groups and the shared feature matrix once. Everything built
+        here is read-only afterwards, so concurrent requests never write shared state
+        '''
+        if self._id_index is not None:
+            return
+        with self._lock:
+            if self._id_index is not None:   # another request built it while we waited
+                return
+            if self._store is not None:
+                self._id_codes = self._store.id_codes
+                self._first_rows = self._store.first_rows
+                self._label_array = self._store.labels
+                self._cluster_rows = self._store.clusterRows()
+                self._id_index = self._store.idCode   # the store keeps its own sorted id index on disk
+                return
+
+            if 'cluster' in self._data.columns:
+                labels = self._data['cluster'].to_numpy()
+                order = np.argsort(labels, kind='stable')
+                uniques, starts = np.unique(labels[order], return_index=True)
+                self._label_array = labels
+                self._cluster_rows = dict(zip(uniques, np.split(order, starts[1:])))
+
+            columns = [col for col in FEATURE_COLS if col in self._data.columns]
+            matrix = np.array(self._data[columns].to_numpy(dtype=np.float64), order='C', copy=True)
+            matrix.flags.writeable = False
+            self._matrix = matrix
+            self._columns = {col: i for i, col in enumerate(columns)}
+
+            codes, uniques = pd.factorize(self._data['id'])
+            first_rows = np.empty(len(uniques), dtype=np.intp)
+            first_rows[codes[::-1]] = np.arange(len(codes))[::-1]   # reversed so the first occurrence wins, like .values[0]
+            self._id_codes = codes
+            self._first_rows = first_rows
+            self._id_index = dict(zip(uniques, range(len(uniques))))   # set last, it marks the structures as ready
+
+    def _locate(self, targetID):
+        '''
+        Finds the row of the target song
+        params: targetID(str) = ID of target song
+        returns: (int, int) = row position of the target and the integer code of its id
+        '''
+        self._prepare()
+        code = self._id_index(targetID) if self._store is not None else self._id_index.get(targetID)
+        if code is None:
+            raise IndexError(f"Song ID {targetID} was not found in the dataset")
+        return self._first_rows[code], code
+
+    def _clusterRows(self):
+        '''
+        Row positions grouped by cluster label so the cluster filter is a dictionary lookup
+        returns: dict = cluster label -> np.ndarray of row positions
+        '''
+        self._prepare()
+        return self._cluster_rows
+
+    def _labels(self):
+        '''
+        Cluster label of every row
+        returns: np.ndarray = labels, or None if the data is not clustered
+        '''
+        self._prepare()
+        return self._label_array
+
+    def _featureMatrix(self, features):
+        '''
+        Matrix of the selected features with every row scaled to unit length. For a DataFrame this is a masked view
+        over the shared matrix, so picking features never copies or rebinds the dataset. Only when matrix_cache_size
+        is set is the view copied into a contiguous matrix, once per selection held by the cache
+        params: features(list) = features to consider for similarity
+        returns: _MaskedMatrix or np.memmap = n_songs x n_features matrix of L2-normalized rows
+        '''
+        if self._store is not None:
+            return self._store.matrix(features)
+        self._prepare()
+        for feature in features:
+            if feature not in self._columns:
+                raise KeyError(f"Feature {feature} is not in the dataset")
+        features = self._canonical(features)
+        columns = [self._columns[feature] for feature in features]
+        inverse_norms = self._inverse_norms.get(tuple(features))
+        if inverse_norms is None:
+            with self._lock:   # at most one vector per feature selection, computed once
+                inverse_norms = self._inverse_norms.get(tuple(features))
+                if inverse_norms is None:
+                    inverse_norms = self._inverse_norms[tuple(features)] = _inverseNorms(self._matrix, columns)
+        view = _MaskedMatrix(self._matrix, columns, inverse_norms)
+        if self._matrix_cache.max_size <= 0:
+            return view
+
+        # materialize the view once per selection so repeated requests read a contiguous matrix
+        matrix = self._matrix_cache.get(tuple(features))
+        if matrix is None:
+            matrix = view[:]
+            matrix.flags.writeable = False
+            self._matrix_cache.put(tuple(features), matrix)
+        return matrix
+
+    def _canonical(self, features):
+        '''
+        The selected features in dataset column order, which is the column order of every normalized matrix
+        params: features(list) = features to consider
+        returns: list = the same features, reordered
+        '''
+        self._prepare()
+        order = self._store.features if self._store is not None else list(self._columns)
+        selected = set(features)
+        return [feature for feature in order if feature in selected]
+
+    def _results(self, rows, similarity):
+        '''
+        Materializes only the recommended rows into the returned DataFrame
+        params: rows(np.ndarray) = row positions of recommended songs, similarity(np.ndarray) = their scores in percent
+        returns: pd.DataFrame = name, artists, similarity and cluster (if present) of the recommended songs
+        '''
+        recs = self._rowsFrame(rows, ['name', 'artists'])
+        recs['similarity'] = [f"{x:.2f}%" for x in similarity]  # add percent sign to similarity
+        labels = self._labels()
+        if labels is not None:
+            recs['cluster'] = labels[rows]
+        return recs
+
+    def _rowsFrame(self, rows, columns):
+        '''
+        Copies the given rows and columns out of the dataset
+        params: rows(np.ndarray) = row positions, columns(list) = column names
+        returns: pd.DataFrame = the selected rows
+        '''
+        if self._store is not None:
+            return self._store.frame(rows, columns)
+        return self._data.iloc[rows, self._data.columns.get_indexer(columns)].copy()
+
+    def attachNeighbors(self, graph):
+        '''
+        Serves recommend from a precomputed neighbour table whenever a request matches its feature selection,
+        cluster priority and size; other requests are still scored live. Call before serving requests
+        params: graph(NeighborGraph) = table built from this dataset
+        '''
+        self._prepare()
+        if graph.meta['rows'] != len(self._id_codes):
+            raise ValueError("The neighbour graph was built from a different dataset.")
+        self._graphs = self._graphs + [graph]
+
     def cosineSimilarity(self, targetID, features):
         '''
         Calculates cosine similarity between target song and all other songs
         params: targetID (str) = ID of target song for comparison, features = features user wants to consider for similarity
         returns: np.ndarray: array of similarity scores between target song and others
         '''
-        
-        # extract features of target
-        target_features = self.data.loc[self.data['id'] == targetID, features].values[0]
-        
-        # features for the reat of the songs
-        total_features = self.data[features].values
-        
-        # avoid dividing by 0
-        norm_target = np.linalg.norm(target_features) or 1  # default to 1 if magnitude is 0
-        norm_all = np.linalg.norm(total_features, axis=1)
-        norm_all[norm_all == 0] = 1  # replace zero magnitudes with 1 to avoid division errors
-
-        
-        #cosine similarity calculation
-        dot_product = np.dot(total_features, target_features)  # dot product
-        norm_target = np.linalg.norm(target_features)  # magnitude of target features
-        norm_all = np.linalg.norm(total_features, axis=1)  # magnitudes of all features
-        similarity = dot_product / (norm_all * norm_target)  # cosine similarity formula
-        
+        row, _ = self._locate(targetID)
+        matrix = self._featureMatrix(features)
+
+        # rows are already unit length, so cosine similarity is a single matrix-vector product
+        similarity = matrix @ matrix[row]
+
         sim_perc = similarity * 100  # convert similarity to percentage for better user understanding
-        
+
         return sim_perc
-    
-    def recommend(self, targetID, features, top=5, cluster_priority=True):
+
+    def _probeRows(self, target_features, features, top, n_probe):
+        '''
+        IVF-style candidate selection: ranks the cluster centroids against the target and gathers the inverted
+        lists of the n_probe closest ones, probing further lists until there are more than top candidates
+        params: target_features(np.ndarray) = normalized target vector, features(list) = features to consider,
+                top(int) = number of recommendations, n_probe(int) = number of clusters to scan
+        returns: np.ndarray = row positions of the candidate songs
+        '''
+        labels, centroids = self._centroidMatrix(features)
+        cluster_rows = self._clusterRows()
+        order = np.argsort(-(centroids @ target_features), kind='stable')
+        probed = [cluster_rows[label] for label in labels[order[:n_probe]]]
+        count = sum(len(rows) for rows in probed)
+        for label in labels[order[n_probe:]]:
+            if count > top:
+                break
+            probed.append(cluster_rows[label])
+            count += len(cluster_rows[label])
+        return np.concatenate(probed)
+
+    def _centroidMatrix(self, features):
+        '''
+        Unit-length cluster centroids for the selected features, taken from the fitted K-Means model when it
+        was trained on those features, otherwise averaged from the normalized rows of each cluster
+        params: features(list) = features to consider
+        returns: (np.ndarray, np.ndarray) = cluster labels and their normalized centroids, in matching order
+        '''
+        features = self._canonical(features)
+        key = tuple(features)
+        if key in self._centroids:
+            return self._centroids[key]
+        cluster_rows = self._clusterRows()
+        labels = np.array(list(cluster_rows))
+        model_features = list(getattr(self.cluster_model, 'feature_names_in_', []))
+        if all(feature in model_features for feature in features):
+            columns = [model_features.index(feature) for feature in features]
+            centroids = self.cluster_model.cluster_centers_[labels][:, columns]
+        else:
+            matrix = self._featureMatrix(features)
+            centroids = np.vstack([matrix[rows].mean(axis=0) for rows in cluster_rows.values()])
+        norms = np.linalg.norm(centroids, axis=1)
+        norms[norms == 0] = 1
+        with self._lock:
+            return self._centroids.setdefault(key, (labels, centroids / norms[:, None]))
+
+    def _rankRows(self, targetID, features, top, cluster_priority, n_probe=None):
+        '''
+        Finds the rows and similarity scores of the best matches for the target
+        params: targetID(str) = ID of target song, features(list) = features to consider, top(int) = number of matches,
+                cluster_priority(bool) = prefer the target's cluster, n_probe(int) = scan only the n_probe closest clusters
+        returns: (np.ndarray, np.ndarray) = row positions and similarity percentages, best first
+        '''
+        with metrics.timer('recommend_phase_seconds', phase='lookup'):
+            row, code = self._locate(targetID)
+            labels = self._labels()
+        if n_probe is None:
+            for graph in self._graphs:
+                if graph.matches(features, top, cluster_priority and labels is not None):
+                    with metrics.timer('recommend_phase_seconds', phase='neighbors'):
+                        return graph.lookup(row, top)   # precomputed, no scoring needed
+
+        matrix = self._featureMatrix(features)
+        target_features = matrix[row]
+        codes = self._id_codes
+
+        if n_probe is not None and labels is not None:
+            with metrics.timer('recommend_phase_seconds', phase='candidates'):
+                candidates = self._probeRows(target_features, features, top, n_probe)
+                candidates = candidates[codes[candidates] != code]                   # exclude target song
+            with metrics.timer('recommend_phase_seconds', phase='scoring'):
+                similarity = (matrix[candidates] @ target_features) * 100
+            with metrics.timer('recommend_phase_seconds', phase='ranking'):
+                best = _topK(similarity, top)
+            return candidates[best], similarity[best]
+
+        # if user wants to prioritize recs in same cluster as target
+        clustered = cluster_priority and labels is not None
+        with metrics.timer('recommend_phase_seconds', phase='candidates'):
+            if clustered:
+                candidates = self._clusterRows()[labels[row]]    # songs in the same cluster as the target
+                candidates = candidates[codes[candidates] != code]                   # exclude target song
+            else:
+                candidates = np.flatnonzero(codes != code)                           # entire dataset minus the target song
+        with metrics.timer('recommend_phase_seconds', phase='scoring'):
+            if clustered:
+                similarity = (matrix[candidates] @ target_features) * 100
+            else:
+                similarity = (matrix @ target_features)[candidates] * 100
+
+        with metrics.timer('recommend_phase_seconds', phase='ranking'):
+            best = _topK(similarity, top)
+            rows, scores = candidates[best], similarity[best]
+
+        # Fallback to global dataset if the cluster has fewer songs than requested
+        if len(candidates) < top:
+            with metrics.timer('recommend_phase_seconds', phase='fallback'):
+                global_rows = np.flatnonzero(~np.isin(codes, np.append(codes[candidates], code)))
+                global_similarity = (matrix @ target_features)[global_rows] * 100
+                global_best = _topK(global_similarity, top - len(rows))
+                rows = np.concatenate([rows, global_rows[global_best]])
+                scores = np.concatenate([scores, global_similarity[global_best]])
+
+        return rows, scores
+
+    @metrics.timed('recommend_seconds')
+    def recommend(self, targetID, features, top=5, cluster_priority=True, n_probe=None):
         '''
         Recommends songs similar to the target based on similarity scores, optionally using clustering.
-        params: targetID(str): ID of target song, top(int): number of recommendations to return, features(): features to consider
+        With n_probe set, only the songs of the n_probe clusters whose centroids are closest to the target are
+        scanned (approximate search, higher n_probe trades latency for recall) and cluster_priority is ignored.
+        params: targetID(str): ID of target song, top(int): number of recommendations to return, features(): features to consider,
+                n_probe(int): number of clusters to scan for approximate search
         returns: pd.DataFrame = top n recommended songs with details and similarity scores
         '''
-    
-        # if user wants to prioritize recs in same cluster as target
-        if cluster_priority and 'cluster' in self.data.columns:
-            target_cluster = self.data.loc[self.data['id'] == targetID, 'cluster'].values[0]     # cluster of target song 
-            cluster_songs = self.data[self.data['cluster'] == target_cluster].copy()             # filter data to only include songs in the same cluster
-            
-        else:
-            cluster_songs = self.data.copy() # use entire dataset
-        
-        cluster_songs = cluster_songs[cluster_songs['id'] != targetID] # exclude target song
-        
-        # calculate similarity scores
-        cluster_features = cluster_songs[features].values
-        target_features = self.data.loc[self.data['id'] == targetID, features].values[0]
-        
-        # cosine similarity for the filtered dataset
-        dot_product = np.dot(cluster_features, target_features)
-        norm_target = np.linalg.norm(target_features) or 1
-        norm_cluster = np.linalg.norm(cluster_features, axis=1)
-        norm_cluster[norm_cluster == 0] = 1                              # avoid division by zero
-        similarity = (dot_product / (norm_cluster * norm_target)) * 100  # convert to percentage
-
-        # assign similarity scores to the filtered songs
-        cluster_songs['similarity'] = similarity
-        
-        # sort by similarity
-        recs = cluster_songs.sort_values(by='similarity', ascending=False)
-        
-        # Fallback to global dataset if needed
-        if len(recs) < top:
-            remaining = top - len(recs)
-            global_songs = self.data[~self.data['id'].isin(recs['id'])]
-            global_songs = global_songs[global_songs['id'] != targetID]  # Exclude the target song
-            global_features = global_songs[features].values
-
-            # Global similarity calculation
-            dot_product_global = np.dot(global_features, target_features)
-            norm_global = np.linalg.norm(global_features, axis=1)
-            norm_global[norm_global == 0] = 1
-            global_similarity = (dot_product_global / (norm_global * norm_target)) * 100
-            global_songs['similarity'] = global_similarity
-
-            # Sort global songs by similarity and append to recommendations
-            global_recs = global_songs.sort_values(by='similarity', ascending=False).head(remaining)
-            recs = pd.concat([recs, global_recs])
-
-        # add percent sign to similarity
-        recs['similarity'] = recs['similarity'].apply(lambda x: f"{x:.2f}%")
-        recs = recs.head(top)
-
-        # Conditionally include 'cluster' in the result if it exists
-        columns_to_return = ['name', 'artists', 'similarity']
-        if 'cluster' in recs.columns:
-            columns_to_return.append('cluster')
-
-        return recs[columns_to_return]
+        key = (targetID, tuple(sorted(set(features))), top, bool(cluster_priority), n_probe)
+        recs = self.cache.get(key)
+        if recs is None:
+            rows, scores = self._rankRows(targetID, features, top, cluster_priority, n_probe)
+            with metrics.timer('recommend_phase_seconds', phase='results'):
+                recs = self._results(rows, scores)
+            self.cache.put(key, recs)
+        return recs.copy()   # callers get their own copy, the cached frame stays untouched
+
+    def cacheStats(self):
+        '''
+        Hit, miss and eviction counters of the result and feature matrix caches
+        returns: dict = counters per cache
+        '''
+        return {'results': self.cache.stats(), 'matrices': self._matrix_cache.stats()}
+
+    def recallAtK(self, target_ids, features, top=5, n_probe=1):
+        '''
+        Measures how many of the exact global top matches the cluster-probed search finds
+        params: target_ids(list) = IDs of songs to query, features(list) = features to consider, top(int) = k,
+                n_probe(int) = number of clusters to scan
+        returns: float = mean recall@k over the targets, between 0 and 1
+        '''
+        recalls = []
+        for targetID in target_ids:
+            exact, _ = self._rankRows(targetID, features, top, cluster_priority=False)
+            approx, _ = self._rankRows(targetID, features, top, cluster_priority=False, n_probe=n_probe)
+            recalls.append(len(np.intersect1d(exact, approx)) / max(len(exact), 1))
+        return float(np.mean(recalls)) if recalls else 0.0
+
+    def recommend_many(self, target_ids, features, top=5, cluster_priority=True, block_size=256, catalog_block=32768):
+        '''
+        Recommends songs for many target songs at once. Seeds are scored in blocks with one matrix product per
+        block x catalog tile, so peak memory is about block_size * catalog_block scores whatever the catalog size.
+        Same-cluster songs come first and the rest of the catalog fills in when the cluster is too small, like recommend.
+        params: target_ids(list): IDs of target songs, features(list): features to consider, top(int): recommendations per target,
+                cluster_priority(bool): prefer songs in the target's cluster, block_size(int): seeds per block, catalog_block(int): songs per tile
+        returns: pd.DataFrame = one row per recommendation with seed_id, rank, id, name, artists, similarity (percent) and cluster (if present)
+        '''
+        located = [self._locate(targetID) for targetID in target_ids]
+        seed_rows = np.array([row for row, _ in located], dtype=np.intp)
+        seed_codes = np.array([code for _, code in located], dtype=np.intp)
+        matrix = self._featureMatrix(features)
+        codes = self._id_codes
+        labels = self._labels() if cluster_priority else None
+
+        rec_rows, rec_scores = [], []
+        for start in range(0, len(seed_rows), block_size):
+            best_rows, best_scores = _blockTopK(matrix, seed_rows[start:start + block_size], seed_codes[start:start + block_size],
+                                                codes, labels, top, catalog_block)
+            rec_rows.append(best_rows)
+            rec_scores.append(best_scores)
+
+        width = min(top, len(matrix)) if top > 0 else 0
+        rec_rows = np.vstack(rec_rows) if rec_rows else np.empty((0, width), dtype=np.intp)
+        rec_scores = np.vstack(rec_scores) if rec_scores else np.empty((0, width))
+        valid = np.isfinite(rec_scores).ravel()   # catalogs smaller than top leave excluded songs in the tail
+
+        rows = rec_rows.ravel()[valid]
+        recs = self._rowsFrame(rows, ['id', 'name', 'artists']).reset_index(drop=True)
+        recs.insert(0, 'seed_id', np.repeat(np.asarray(target_ids, dtype=object), width)[valid])
+        recs.insert(1, 'rank', np.tile(np.arange(1, width + 1), len(rec_rows))[valid])
+        recs['similarity'] = rec_scores.ravel()[valid]
+        labels = self._labels()
+        if labels is not None:
+            recs['cluster'] = labels[rows]
+        return recs
+
+    def recommendPlaylist(self, seed_ids, features, top=10, mode='centroid', per_artist_cap=None, catalog_block=32768):
+        '''
+        Recommends songs that continue a playlist. The catalog is scored in one pass of matrix products against either
+        the normalized mean of the seeds ('centroid') or every seed, keeping each song's best match ('multi-vector'),
+        and every seed is excluded with a boolean mask over id codes. Seeds missing from the dataset are ignored
+        params: seed_ids(list): IDs of the playlist songs, features(list): features to consider, top(int): number of recommendations,
+                mode(str): 'centroid' or 'multi-vector', per_artist_cap(int): most songs per artists value, None for no cap,
+                catalog_block(int): songs per tile
+        returns: pd.DataFrame = top recommended songs with details and similarity scores, like recommend
+        '''
+        if mode not in ('centroid', 'multi-vector'):
+            raise ValueError(f"Unknown playlist mode {mode}, expected 'centroid' or 'multi-vector'")
+        located = []
+        for targetID in dict.fromkeys(seed_ids):
+            try:
+                located.append(self._locate(targetID))
+            except IndexError:
+                continue
+        if not located:
+            raise IndexError("None of the playlist songs were found in the dataset")
+
+        matrix = self._featureMatrix(features)
+        codes = self._id_codes
+        excluded = np.zeros(len(self._first_rows), dtype=bool)
+        excluded[[code for _, code in located]] = True
+        seeds = matrix[np.array([row for row, _ in located], dtype=np.intp)]
+        if mode == 'centroid':
+            seeds = seeds.mean(axis=0, keepdims=True)
+            norm = np.linalg.norm(seeds)
+            seeds = seeds / norm if norm > 0 else seeds
+
+        scores = np.empty(len(matrix))
+        for start in range(0, len(matrix), catalog_block):
+            end = min(start + catalog_block, len(matrix))
+            scores[start:end] = (seeds @ matrix[start:end].T).max(axis=0) * 100
+        scores[excluded[codes]] = -np.inf
 
+        # widen the candidate list until the artist cap leaves enough songs
+        width = top
+        while True:
+            candidates = _topK(scores, width)
+            candidates = candidates[np.isfinite(scores[candidates])]
+            if per_artist_cap is None:
+                chosen = candidates[:top]
+                break
+            counts, chosen = {}, []
+            for row, artists in zip(candidates, self._rowsFrame(candidates, ['artists'])['artists']):
+                if counts.get(artists, 0) < per_artist_cap:
+                    counts[artists] = counts.get(artists, 0) + 1
+                    chosen.append(row)
+                    if len(chosen) == top:
+                        break
+            if len(chosen) == top or width >= len(scores):
+                chosen = np.array(chosen, dtype=np.intp)
+                break
+            width *= 4
+        return self._results(chosen, scores[chosen])
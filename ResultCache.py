@@ -0,0 +1,72 @@
+# Description: This module defines the ResultCache class, a small thread-safe LRU cache with an optional time to live,
+# used by the Recommender to memoize recommendations and normalized feature matrices.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        '''
+        params: max_size(int) = entries kept before the least recently used one is evicted, 0 disables the cache,
+                ttl(float) = seconds an entry stays valid, None for no expiry, clock(callable) = time source in seconds
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()   # key -> (time stored, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0              # entries dropped for space or because they expired
+        self.invalidations = 0
+
+    def get(self, key):
+        '''
+        Looks up a key and marks it as recently used
+        params: key = hashable cache key
+        returns: the cached value, or None on a miss
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and self._clock() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        '''
+        Stores a value, evicting the least recently used entries beyond max_size
+        params: key = hashable cache key, value = value to cache
+        '''
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        '''
+        Drops every entry, used when the data behind the cache is rebuilt
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        '''
+        returns: dict = hit, miss, eviction and invalidation counters plus the current size
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self._entries), 'max_size': self.max_size}
@@ -0,0 +1,170 @@
+# Description: This module defines the SearchIndex class used by the dashboard typeahead. Casefolded names and artists
+# are kept as UTF-8 buffers with offsets, with the rows sorted by name for prefix lookups and a byte-trigram inverted
+# index for substring lookups, so a search touches only the songs that can match. For a FeatureStore the arrays are
+# written next to the store and memory-mapped, so every server worker shares one copy through the page cache.
+
+import bisect
+import json
+import os
+import shutil
+
+import numpy as np
+
+from DataProcessor import _encodeStrings
+from FeatureStore import FeatureStore
+
+SEARCH_VERSION = 1
+_ARRAYS = ['name_bytes', 'name_offsets', 'artists_bytes', 'artists_offsets', 'order', 'grams', 'gram_starts', 'postings']
+
+
+def _trigrams(data, offsets):
+    '''
+    Every byte trigram of every row, packed into one integer
+    params: data(np.ndarray) = uint8 buffer, offsets(np.ndarray) = row offsets into data
+    returns: (np.ndarray, np.ndarray) = packed trigrams and the row each one belongs to
+    '''
+    lengths = np.diff(offsets)
+    if len(data) < 3:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+    values = data.astype(np.uint64)
+    grams = (values[:-2] << np.uint64(16)) | (values[1:-1] << np.uint64(8)) | values[2:]
+    rows = np.repeat(np.arange(len(lengths), dtype=np.uint64), lengths)[:-2]
+    valid = np.arange(len(grams)) + 2 < offsets[1:][rows.astype(np.intp)]   # the trigram ends inside its own row
+    return grams[valid], rows[valid]
+
+
+def _buildArrays(names, artists):
+    '''
+    Builds every array of the index
+    params: names(list) = song names, artists(list) = artists of each song
+    returns: dict = array name -> np.ndarray
+    '''
+    arrays = {}
+    for col, values in [('name', names), ('artists', artists)]:
+        arrays[f'{col}_bytes'], arrays[f'{col}_offsets'] = _encodeStrings(str(value).casefold() for value in values)
+
+    # prefix structure: rows ordered by casefolded name, UTF-8 byte order is code point order
+    names_cf = [bytes(arrays['name_bytes'][start:end]) for start, end in zip(arrays['name_offsets'][:-1], arrays['name_offsets'][1:])]
+    arrays['order'] = np.array(sorted(range(len(names_cf)), key=names_cf.__getitem__), dtype=np.int64)
+
+    # trigram -> rows whose name or artists contain it, as one sorted postings array with a start offset per trigram
+    name_grams, name_rows = _trigrams(arrays['name_bytes'], arrays['name_offsets'])
+    artist_grams, artist_rows = _trigrams(arrays['artists_bytes'], arrays['artists_offsets'])
+    pairs = np.unique(np.concatenate([(name_grams << np.uint64(32)) | name_rows, (artist_grams << np.uint64(32)) | artist_rows]))
+    grams = pairs >> np.uint64(32)
+    arrays['grams'], starts = np.unique(grams, return_index=True)
+    arrays['gram_starts'] = np.append(starts, len(pairs)).astype(np.int64)
+    arrays['postings'] = (pairs & np.uint64(0xFFFFFFFF)).astype(np.int64)
+    return arrays
+
+
+class SearchIndex:
+    def __init__(self, data):
+        '''
+        Opens or builds the index over the song names and artists of the dataset. For a FeatureStore the index is
+        built once into the store directory and memory-mapped from then on
+        params: data(pd.DataFrame or FeatureStore) = dataset with 'id', 'name' and 'artists' columns
+        '''
+        self._data = data
+        if isinstance(data, FeatureStore):
+            directory = os.path.join(data.directory, 'search')
+            if not os.path.exists(os.path.join(directory, 'meta.json')):
+                SearchIndex._write(directory, _buildArrays(data.strings('name'), data.strings('artists')))
+            arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in _ARRAYS}
+        else:
+            arrays = _buildArrays(data['name'].tolist(), data['artists'].tolist())
+        for name, array in arrays.items():
+            setattr(self, f'_{name}', array)
+
+    @staticmethod
+    def _write(directory, arrays):
+        staging = f"{directory}.tmp-{os.getpid()}"
+        os.makedirs(staging, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, f'{name}.npy'), array)
+        with open(os.path.join(staging, 'meta.json'), 'w') as f:
+            json.dump({'version': SEARCH_VERSION}, f)
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            shutil.rmtree(staging)   # another worker wrote the same index first
+
+    def __len__(self):
+        return len(self._name_offsets) - 1
+
+    def _name(self, row):
+        return bytes(self._name_bytes[self._name_offsets[row]:self._name_offsets[row + 1]])
+
+    def _artists(self, row):
+        return bytes(self._artists_bytes[self._artists_offsets[row]:self._artists_offsets[row + 1]])
+
+    def _candidates(self, query):
+        '''
+        Rows that contain every trigram of the query, intersecting the shortest posting lists first
+        params: query(bytes) = casefolded UTF-8 query of at least 3 bytes
+        returns: np.ndarray = row positions in dataset order
+        '''
+        lists = []
+        for gram in {(query[i] << 16) | (query[i + 1] << 8) | query[i + 2] for i in range(len(query) - 2)}:
+            position = int(np.searchsorted(self._grams, gram))
+            if position == len(self._grams) or self._grams[position] != gram:
+                return np.empty(0, dtype=np.int64)
+            lists.append(self._postings[self._gram_starts[position]:self._gram_starts[position + 1]])
+        lists.sort(key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+            if len(rows) == 0:
+                break
+        return rows
+
+    def _rows(self, rows):
+        '''
+        returns: list = (id, name, artists) tuples of the rows, read from the store or the DataFrame
+        '''
+        if isinstance(self._data, FeatureStore):
+            frame = self._data.frame(rows, ['id', 'name', 'artists'])
+        else:
+            frame = self._data.iloc[rows][['id', 'name', 'artists']]
+        return [(str(song_id), str(name), str(artists)) for song_id, name, artists in frame.itertuples(index=False)]
+
+    def search(self, query, limit=50):
+        '''
+        Finds songs whose name or artists contain the query, ignoring case. Names starting with the query come
+        first, then names containing it, then songs that only match on artists
+        params: query(str) = text typed by the user, limit(int) = maximum number of results
+        returns: list = (id, name, artists) tuples, best match first
+        '''
+        query = (query or '').casefold().encode('utf-8')
+        if not query or limit <= 0:
+            return []
+        seen, results = set(), []
+
+        def add(row):
+            if row not in seen:
+                seen.add(row)
+                results.append(row)
+            return len(results) >= limit
+
+        # names starting with the query form one contiguous range of the sorted rows
+        start = bisect.bisect_left(self._order, query, key=self._name)
+        for i in range(start, len(self._order)):
+            row = int(self._order[i])
+            if not self._name(row).startswith(query) or add(row):
+                break
+
+        if len(results) < limit:
+            rows = self._candidates(query) if len(query) >= 3 else range(len(self))
+            artist_rows = []
+            for row in rows:
+                row = int(row)
+                if query in self._name(row):
+                    if add(row):
+                        break
+                elif len(artist_rows) < limit and query in self._artists(row):
+                    artist_rows.append(row)
+            for row in artist_rows:
+                if len(results) >= limit or add(row):
+                    break
+
+        return self._rows(results)
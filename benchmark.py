@@ -0,0 +1,274 @@
+# Description: This module is the benchmark harness for the whole pipeline. It writes a deterministic synthetic catalog
+# of any size and times loadData (full, compact, and compact with the sidecar cache, each in a fresh process so their
+# peak memory can be compared), clean, preprocessData, clusterData, the song search and recommend on it. It records the
+# peak resident memory of every stage and writes the results as JSON that can be compared against a stored baseline.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from DataProcessor import DataProcessor, FEATURE_COLS
+from Metrics import _currentRss
+from Recommender import Recommender
+from SearchIndex import SearchIndex
+
+try:
+    import resource
+except ImportError:  # not available on Windows, memory is then reported as None
+    resource = None
+
+FEATURE_SUBSETS = [['valence', 'danceability', 'energy'], FEATURE_COLS, ['tempo'], ['energy', 'acousticness']]
+TIMED_METRICS = ('seconds', 'p50_ms', 'p99_ms')   # compared against the baseline, lower is better
+
+_WORDS = ['love', 'night', 'dance', 'heart', 'fire', 'blue', 'summer', 'dream', 'rain', 'gold', 'city', 'wild',
+          'home', 'light', 'baby', 'time', 'river', 'star', 'road', 'ghost', 'sugar', 'moon', 'electric', 'lonely']
+
+
+def generateTracks(n, seed=0, start=0, duplicate_rate=0.02, missing_rate=0.001):
+    '''
+    Synthetic tracks shaped like the Spotify dataset: beta-distributed 0..1 features, tempo around 120 BPM, a long
+    tail of artists, exact duplicate rows and a few missing feature values for clean to handle
+    params: n(int) = number of rows, seed(int) = random seed, start(int) = number of the first id,
+            duplicate_rate(float) = share of rows that repeat an earlier row, missing_rate(float) = share of missing feature values
+    returns: pd.DataFrame = n rows with the columns DataProcessor requires
+    '''
+    rng = np.random.default_rng([seed, start])
+    words = np.array(_WORDS)
+    names = pd.Series(words[rng.integers(len(words), size=n)]).str.title() + ' ' + pd.Series(words[rng.integers(len(words), size=n)])
+    artist_ids = (rng.zipf(1.5, n) - 1) % max(n // 20, 1)
+    tracks = pd.DataFrame({
+        'id': [f"trk{i:09d}" for i in range(start, start + n)],
+        'name': names,
+        'artists': [f"Artist {i}" for i in artist_ids],
+        'valence': rng.beta(2.0, 2.0, n),
+        'danceability': rng.beta(5.0, 3.0, n),
+        'energy': rng.beta(3.0, 2.0, n),
+        'tempo': np.clip(rng.normal(120, 28, n), 40, 220),
+        'acousticness': rng.beta(0.5, 1.5, n)
+    })
+    for col in FEATURE_COLS:
+        tracks.loc[rng.random(n) < missing_rate, col] = np.nan
+
+    duplicates = np.flatnonzero(rng.random(n) < duplicate_rate)
+    duplicates = duplicates[duplicates > 0]
+    sources = (rng.random(len(duplicates)) * duplicates).astype(np.intp)   # always an earlier row
+    tracks.iloc[duplicates] = tracks.iloc[sources].to_numpy()
+    return tracks
+
+
+def writeTracks(path, n, seed=0, chunksize=500_000):
+    '''
+    Writes a synthetic catalog to CSV chunk by chunk, so 10M rows never sit in memory at once
+    params: path(str) = output CSV, n(int) = number of rows, seed(int) = random seed, chunksize(int) = rows per chunk
+    '''
+    for start in range(0, n, chunksize):
+        generateTracks(min(chunksize, n - start), seed, start).to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+
+def _peakRss():
+    '''
+    returns: float = peak resident memory of the process so far in MB, or None where it cannot be read
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024, 1)   # bytes on macOS, KB on Linux
+
+
+def _processPeakRss():
+    '''
+    Peak resident memory of this process image from /proc/self/status. Unlike ru_maxrss it starts over after exec,
+    so a child does not inherit the peak of the process that started it
+    returns: float = VmHWM in MB, falling back to _peakRss where /proc is not available
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return _peakRss()
+
+
+def _resetPeakRss():
+    '''
+    Starts a new peak measurement by resetting VmHWM to the current resident memory (Linux 4.0 and later)
+    returns: bool = whether the peak was reset, so _processPeakRss covers only what runs from now on
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _loadProbe(path, compact, cache):
+    '''
+    Runs one loadData in the current process, meant to be a fresh interpreter started by _measureLoad
+    returns: dict = load seconds, peak and starting resident memory in MB, size of the resulting frame, source of the data
+    '''
+    before = _currentRss()
+    processor = DataProcessor(path)
+    processor.loadData(compact=compact, cache=cache)
+    peak = _processPeakRss()
+    return {'seconds': round(processor.load_stats['seconds'], 4), 'peak_rss_mb': peak,
+            'baseline_rss_mb': round(before / (1 << 20), 1) if before is not None else None,
+            'frame_bytes': int(processor.data.memory_usage(deep=True).sum()),   # size of the result, measured after the timed load
+            'source': processor.load_stats['source']}
+
+
+def _measureLoad(path, compact=False, cache=False):
+    '''
+    Measures loadData in a separate interpreter, so its peak memory is not hidden by the peak of earlier stages
+    returns: dict = see _loadProbe
+    '''
+    code = f"import json, benchmark; print(json.dumps(benchmark._loadProbe({path!r}, {compact!r}, {cache!r})))"
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _latency(samples):
+    return {'p50_ms': round(float(np.percentile(samples, 50)) * 1000, 4),
+            'p99_ms': round(float(np.percentile(samples, 99)) * 1000, 4), 'calls': len(samples)}
+
+
+def runBenchmark(rows, cluster_counts=(10,), queries=200, seed=0, directory=None, mini_batch=None):
+    '''
+    Runs every pipeline stage on a synthetic catalog
+    params: rows(int) = catalog size, cluster_counts(list) = cluster counts to fit and query, queries(int) = calls per latency measurement,
+            seed(int) = random seed, directory(str) = where the CSV is written, a temporary directory by default,
+            mini_batch(bool) = fit with mini-batch K-Means, by default above one million rows
+    returns: dict = stage timings with peak memory, search latency and recommend latency per cluster count and feature subset
+    '''
+    result = {'rows': rows, 'stages': {}, 'search': {}, 'recommend': {}}
+    mini_batch = rows > 1_000_000 if mini_batch is None else mini_batch
+    rng = np.random.default_rng(seed)
+
+    def stage(name, function):
+        reset = _resetPeakRss()
+        start = time.perf_counter()
+        value = function()
+        result['stages'][name] = {'seconds': round(time.perf_counter() - start, 4)}
+        if reset:
+            result['stages'][name]['peak_rss_mb'] = _processPeakRss()   # highest resident memory during this stage only
+        else:
+            result['stages'][name]['process_peak_rss_mb'] = _peakRss()  # no per-stage reset here, the peak of the run so far
+        return value
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        path = os.path.join(tmp, 'tracks.csv')
+        stage('generate', lambda: writeTracks(path, rows, seed))
+        # each loader variant in its own process: before/after load time and peak memory on the same file
+        result['stages']['loadData[full]'] = _measureLoad(path)
+        result['stages']['loadData[compact]'] = _measureLoad(path, compact=True)
+        _measureLoad(path, compact=True, cache=True)   # writes the sidecar cache
+        result['stages']['loadData[compact+cache]'] = _measureLoad(path, compact=True, cache=True)
+        processor = DataProcessor(path)
+        stage('loadData', processor.loadData)
+    result['duplicates'] = int(processor.data.duplicated().sum())
+    stage('clean', processor.clean)
+    preprocessed = stage('preprocessData', processor.preprocessData).copy()
+
+    index = stage('searchIndex', lambda: SearchIndex(preprocessed))
+    names = preprocessed['name'].to_numpy()
+    samples = []
+    for name in names[rng.integers(len(names), size=queries)]:
+        offset = rng.integers(max(len(name) - 4, 1))
+        start = time.perf_counter()
+        index.search(name[offset:offset + 4], limit=51)   # what update_song_options asks for
+        samples.append(time.perf_counter() - start)
+    result['search'] = _latency(samples)
+
+    for k in cluster_counts:
+        processor.data = preprocessed.copy()
+        clustered = stage(f'clusterData[k={k}]', lambda: processor.clusterData(n_clusters=k, mini_batch=mini_batch))
+        recommender = Recommender(clustered, processor.cluster_model, cache_size=0)   # measure the work, not the cache
+        targets = clustered['id'].to_numpy()[rng.integers(len(clustered), size=queries)]
+        result['recommend'][f'k={k}'] = {}
+        for features in FEATURE_SUBSETS:
+            recommender.recommend(targets[0], features)   # builds the matrix for this selection once
+            samples = []
+            for targetID in targets:
+                start = time.perf_counter()
+                recommender.recommend(targetID, features)
+                samples.append(time.perf_counter() - start)
+            result['recommend'][f'k={k}']['+'.join(features)] = _latency(samples)
+    return result
+
+
+def _flatten(tree, prefix=''):
+    '''
+    Timed metrics of a result tree keyed by their path, e.g. 'rows=10000/recommend/k=10/tempo/p99_ms'
+    '''
+    flat = {}
+    for key, value in tree.items():
+        path = f'{prefix}/{key}' if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path))
+        elif key in TIMED_METRICS and value is not None:
+            flat[path] = value
+    return flat
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Finds timed metrics that got slower than the baseline by more than the tolerance. Metrics present in only one
+    of the two runs are ignored
+    params: results(dict) = output of main, baseline(dict) = earlier output of main, tolerance(float) = allowed relative slowdown
+    returns: list = one dict per regression with metric, baseline, current and relative change
+    '''
+    current, previous = _flatten(results['runs']), _flatten(baseline['runs'])
+    regressions = []
+    for metric in sorted(current.keys() & previous.keys()):
+        if previous[metric] > 0 and current[metric] > previous[metric] * (1 + tolerance):
+            regressions.append({'metric': metric, 'baseline': previous[metric], 'current': current[metric],
+                                'change': round(current[metric] / previous[metric] - 1, 3)})
+    return regressions
+
+
+def main(sizes, cluster_counts=(10,), queries=200, seed=0, directory=None):
+    '''
+    Benchmarks every catalog size
+    returns: dict = environment description and one runBenchmark result per size, keyed 'rows=<size>'
+    '''
+    return {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'seed': seed,
+        'runs': {f'rows={rows}': runBenchmark(rows, cluster_counts, queries, seed, directory) for rows in sizes}
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic catalogs.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000])   # up to 10_000_000
+    parser.add_argument('--clusters', type=int, nargs='+', default=[10, 30])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help="earlier output to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = main(args.rows, args.clusters, args.queries, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['metric']}: {regression['baseline']} -> {regression['current']} (+{regression['change']:.0%})")
+        sys.exit(1 if regressions else 0)
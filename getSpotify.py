@@ -1,6 +1,21 @@
-import spotipy
+# Description: This module exports the logged in user's playlists to a CSV file through the Spotify Web API.
+# Every playlist and track page is followed through its 'next' link, playlists are fetched concurrently by a bounded
+# pool of workers that all pause when Spotify rate limits them, and playlists whose snapshot_id has not changed since
+# the last export are copied from the previous CSV instead of being downloaded again. The export is then enriched
+# with audio features, cached locally, into the dataset format DataProcessor loads.
+
 import csv
-from spotipy.oauth2 import SpotifyOAuth
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from DataProcessor import FEATURE_COLS, REQUIRED_COLS
 
 CLIENT_ID = 'id'
 CLIENT_SECRET = 'secret'
@@ -8,47 +23,231 @@ REDIRECT_URI = 'http://localhost:8888/callback'
 
 SCOPE = 'playlist-read-private'
 
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    redirect_uri=REDIRECT_URI,
-    scope=SCOPE
-))
-
-def export_playlists_to_csv():
-    playlists = sp.current_user_playlists()
-
-    with open('spotify_playlists.csv', 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['Playlist Name', 'Track Name', 'Artists', 'Album', 'Release Date', 'Duration (ms)', 'Popularity', 'Track ID']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for playlist in playlists['items']:
-            playlist_name = playlist['name']
-            playlist_id = playlist['id']
-
-            results = sp.playlist_tracks(playlist_id)
-            tracks = results['items']
-
-            for item in tracks:
-                track = item['track']
-                track_name = track['name']
-                artists = ', '.join([artist['name'] for artist in track['artists']])
-                album_name = track['album']['name']
-                release_date = track['album']['release_date']
-                duration_ms = track['duration_ms']
-                popularity = track['popularity']
-                track_id = track['id']
-
-                writer.writerow({
-                    'Playlist Name': playlist_name,
-                    'Track Name': track_name,
-                    'Artists': artists,
-                    'Album': album_name,
-                    'Release Date': release_date,
-                    'Duration (ms)': duration_ms,
-                    'Popularity': popularity,
-                    'Track ID': track_id
-                })
-
-export_playlists_to_csv()
+API_URL = 'https://api.spotify.com/v1'
+FIELDNAMES = ['Playlist Name', 'Track Name', 'Artists', 'Album', 'Release Date', 'Duration (ms)', 'Popularity', 'Track ID', 'Playlist ID']
+
+
+class SpotifyClient:
+    def __init__(self, token, base_url=API_URL, max_retries=5, timeout=30, sleep=time.sleep):
+        '''
+        Minimal thread-safe Web API client
+        params: token(str or callable) = access token, or a function returning a fresh one, base_url(str) = API root,
+                max_retries(int) = attempts per request on 429, 5xx responses and network errors, timeout(float) = socket timeout in seconds,
+                sleep(callable) = used to wait out backoffs
+        '''
+        self._token = token
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._resume_at = 0.0   # every worker waits until this time after a 429
+        self.requests = 0
+
+    def _wait(self):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            self._sleep(delay)
+
+    def _backoff(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def get(self, url, params=None):
+        '''
+        GET request with rate limit handling. A 429 pauses all workers for the Retry-After seconds it asks for,
+        server errors, dropped connections and timeouts are retried with exponential backoff
+        params: url(str) = path under base_url or an absolute 'next' link, params(dict) = query parameters
+        returns: dict = decoded JSON response
+        '''
+        if not url.startswith('http'):
+            url = self.base_url + url
+        if params:
+            url += ('&' if '?' in url else '?') + urllib.parse.urlencode(params)
+
+        for attempt in range(self.max_retries + 1):
+            self._wait()
+            token = self._token() if callable(self._token) else self._token
+            request = urllib.request.Request(url, headers={'Authorization': f'Bearer {token}'})
+            with self._lock:
+                self.requests += 1
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return json.load(response)
+            except urllib.error.HTTPError as error:
+                if attempt == self.max_retries or (error.code != 429 and error.code < 500):
+                    raise
+                retry_after = error.headers.get('Retry-After')
+                self._backoff(float(retry_after) if error.code == 429 and retry_after else min(2 ** attempt, 30))
+            except OSError:   # URLError, socket timeouts and reset connections, otherwise one glitch would abort the export
+                if attempt == self.max_retries:
+                    raise
+                self._backoff(min(2 ** attempt, 30))
+
+    def pages(self, url, params=None):
+        '''
+        Follows the 'next' links of a paging object
+        returns: generator = the items of each page, one list per page
+        '''
+        page = self.get(url, params)
+        while True:
+            yield page['items']
+            if not page.get('next'):
+                return
+            page = self.get(page['next'])
+
+
+def _trackRow(playlist, item):
+    '''
+    CSV row for one playlist item, None for removed tracks that come back without track data
+    '''
+    track = item.get('track')
+    if not track:
+        return None
+    return {
+        'Playlist Name': playlist['name'],
+        'Track Name': track['name'],
+        'Artists': ', '.join([artist['name'] for artist in track['artists']]),
+        'Album': track['album']['name'],
+        'Release Date': track['album'].get('release_date'),
+        'Duration (ms)': track['duration_ms'],
+        'Popularity': track.get('popularity'),
+        'Track ID': track['id'],
+        'Playlist ID': playlist['id']
+    }
+
+
+def export_playlists_to_csv(client, output_path='spotify_playlists.csv', state_path=None, max_workers=4):
+    '''
+    Writes every track of every playlist of the user to a CSV file. Rows are streamed to a temporary file as
+    pages arrive and the file replaces the previous export only once every playlist succeeded
+    params: client(SpotifyClient) = API client, output_path(str) = CSV file, state_path(str) = JSON file with the
+            snapshot_id of each exported playlist, defaults to output_path + '.state.json', max_workers(int) = concurrent playlists
+    returns: dict = number of playlists fetched and of playlists reused from the previous export
+    '''
+    state_path = state_path or output_path + '.state.json'
+    previous = {}
+    if os.path.exists(output_path) and os.path.exists(state_path):
+        with open(state_path, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    playlists = [playlist for page in client.pages('/me/playlists', {'limit': 50}) for playlist in page]
+    unchanged = {playlist['id'] for playlist in playlists if previous.get(playlist['id']) == playlist['snapshot_id']}
+    changed = [playlist for playlist in playlists if playlist['id'] not in unchanged]
+
+    staging = f"{output_path}.tmp-{os.getpid()}"
+    lock = threading.Lock()
+    try:
+        with open(staging, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+            writer.writeheader()
+
+            if unchanged:
+                with open(output_path, newline='', encoding='utf-8') as old:
+                    writer.writerows(row for row in csv.DictReader(old) if row.get('Playlist ID') in unchanged)
+
+            def export(playlist):
+                for items in client.pages(f"/playlists/{playlist['id']}/tracks", {'limit': 100}):
+                    rows = [row for row in (_trackRow(playlist, item) for item in items) if row]
+                    with lock:
+                        writer.writerows(rows)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(export, changed))   # re-raises the first failure
+        os.replace(staging, output_path)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({playlist['id']: playlist['snapshot_id'] for playlist in playlists}, f, indent=2)
+    return {'fetched': len(changed), 'reused': len(unchanged)}
+
+
+def _cachedFeatures(cache, ids):
+    '''
+    Audio features already in the cache, including tracks the API had no features for
+    returns: dict = track id -> feature tuple, or None when the API returned no features
+    '''
+    found = {}
+    ids = list(ids)
+    for start in range(0, len(ids), 500):   # stays under sqlite's limit on query parameters
+        chunk = ids[start:start + 500]
+        rows = cache.execute(f"SELECT id, {', '.join(FEATURE_COLS)} FROM features WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        for row in rows:
+            found[row[0]] = None if row[1] is None else row[1:]
+    return found
+
+
+def enrich_with_audio_features(client, playlists_path='spotify_playlists.csv', output_path='spotify_dataset.csv',
+                               cache_path='audio_features.sqlite', batch_size=100, max_workers=4):
+    '''
+    Turns an exported playlist CSV into a dataset DataProcessor can load. Track IDs are deduplicated across
+    playlists and only the ones missing from the local sqlite cache are requested, batch_size per request,
+    with max_workers requests in flight
+    params: client(SpotifyClient) = API client, playlists_path(str) = CSV written by export_playlists_to_csv,
+            output_path(str) = dataset CSV with the id, name, artists and audio feature columns,
+            cache_path(str) = sqlite file keyed by track id, batch_size(int) = ids per request, at most 100,
+            max_workers(int) = concurrent requests
+    returns: dict = number of tracks, of tracks fetched from the API and of tracks written to the dataset
+    '''
+    tracks = {}   # track id -> (name, artists), first occurrence wins
+    with open(playlists_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if row['Track ID'] and row['Track ID'] not in tracks:
+                tracks[row['Track ID']] = (row['Track Name'], row['Artists'])
+
+    cache = sqlite3.connect(cache_path)
+    try:
+        cache.execute(f"CREATE TABLE IF NOT EXISTS features (id TEXT PRIMARY KEY, {', '.join(col + ' REAL' for col in FEATURE_COLS)})")
+        features = _cachedFeatures(cache, tracks)
+        missing = [track_id for track_id in tracks if track_id not in features]
+        batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+
+        def fetch(ids):
+            return ids, client.get('/audio-features', {'ids': ','.join(ids)})['audio_features']
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for ids, results in pool.map(fetch, batches):
+                # unknown tracks come back as null and are cached as such so they are not requested again
+                rows = [(track_id,) + ((None,) * len(FEATURE_COLS) if result is None else tuple(result[col] for col in FEATURE_COLS))
+                        for track_id, result in zip(ids, results)]
+                cache.executemany(f"INSERT OR REPLACE INTO features VALUES ({', '.join('?' * (len(FEATURE_COLS) + 1))})", rows)
+                cache.commit()   # every finished batch survives an interrupted run
+                features.update({row[0]: None if row[1] is None else row[1:] for row in rows})
+    finally:
+        cache.close()
+
+    written = 0
+    staging = f"{output_path}.tmp-{os.getpid()}"
+    try:
+        with open(staging, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(REQUIRED_COLS)
+            for track_id, (name, artists) in tracks.items():
+                if features.get(track_id) is not None:
+                    writer.writerow((track_id, name, artists) + tuple(features[track_id]))
+                    written += 1
+        os.replace(staging, output_path)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+    return {'tracks': len(tracks), 'fetched': len(missing), 'written': written}
+
+
+def _accessToken():
+    '''
+    Token provider backed by spotipy's OAuth flow, which caches the token and refreshes it when it expires
+    returns: callable = returns a valid access token
+    '''
+    from spotipy.oauth2 import SpotifyOAuth
+
+    auth = SpotifyOAuth(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI, scope=SCOPE)
+    return lambda: auth.get_access_token(as_dict=False)
+
+
+if __name__ == "__main__":
+    client = SpotifyClient(_accessToken())
+    export_playlists_to_csv(client)
+    enrich_with_audio_features(client)
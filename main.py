@@ -2,20 +2,19 @@
 # Date: December 10, 2024
 # Description: This module contains the main function that implements the DataProcessor and Recommender classes.
 
-from DataProcessor import DataProcessor
-from Recommender import Recommender
+import os
+
+from Pipeline import Pipeline
 from uiLogin import uiLogin
 
 def main():
-    processor = DataProcessor("data.csv")
-    data = processor.loadData()
-    clean = processor.clean()
-    pp_data = processor.preprocessData()
-    clustered = processor.clusterData(n_clusters=10)
-    
-    recommender = Recommender(clustered)
+    # fixed cluster count unless SPOTIFY_CLUSTERS=auto asks for the (much slower) automatic selection on every build
+    n_clusters = os.environ.get("SPOTIFY_CLUSTERS", "10")
+    n_clusters = n_clusters if n_clusters == "auto" else int(n_clusters)
+    pipeline = Pipeline("data.csv", "artifacts", n_clusters=n_clusters)  # reuses the saved pipeline output unless data.csv changed
+    pipeline.start()  # builds in the background and rebuilds whenever data.csv changes, /ready reports when it is serving
     
-    app = uiLogin(recommender, clustered)
+    app = uiLogin(pipeline=pipeline)
     app.run_server(debug=False)
     
     # this point on is for basic testing. comment out once GUI is integrated.
@@ -24,7 +23,7 @@ def main():
     
     # features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']  # default
     # top = 5
-    # recs = recommender.recommend(user_targetID, features, top=top, cluster_priority=True)
+    # recs = pipeline.snapshot.recommender.recommend(user_targetID, features, top=top, cluster_priority=True)
     
     # print("Top 5 Recommendations: ")
     # print(recs)
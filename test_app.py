@@ -1,8 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
 import pytest
+import benchmark
 import pandas as pd
 import numpy as np
 from DataProcessor import DataProcessor
+from FeatureStore import FeatureStore
+import getSpotify
+from Metrics import Metrics, metrics
+from NeighborGraph import NeighborGraph
+from Pipeline import Pipeline
 from Recommender import Recommender
+from ResultCache import ResultCache
+from SearchIndex import SearchIndex
+from uiLogin import uiLogin
 
 InputData = pd.DataFrame({
     'id': ['1', '2', '3'],
@@ -69,3 +86,683 @@ def test_clustering():
     assert 'cluster' in clustered_data.columns, "Cluster labels should be added to the dataset."
     assert clustered_data['cluster'].nunique() == 2, "There should be exactly 2 clusters."
 
+
+def _random_tracks(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id': [f"id{i}" for i in range(n)],
+        'name': [f"Song{i}" for i in range(n)],
+        'artists': [f"Artist{i % 7}" for i in range(n)],
+        'valence': rng.random(n),
+        'danceability': rng.random(n),
+        'energy': rng.random(n),
+        'tempo': rng.normal(120, 25, n),
+        'acousticness': rng.random(n)
+    })
+
+def _brute_force(data, targetID, features, mask=None):
+    """Reference cosine similarity ranking computed straight from the DataFrame."""
+    songs = data if mask is None else data[mask]
+    songs = songs[songs['id'] != targetID]
+    target = data.loc[data['id'] == targetID, features].values[0]
+    values = songs[features].values
+    similarity = values @ target / (np.linalg.norm(values, axis=1) * np.linalg.norm(target)) * 100
+    return songs.assign(similarity=similarity).sort_values('similarity', ascending=False)
+
+def test_recommend_matches_brute_force():
+    """Test indexed top-k recommendations against a full sort over the DataFrame."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(300)
+    data = processor.clusterData(n_clusters=4)
+    recommender = Recommender(data)
+    features = ['valence', 'energy', 'tempo']
+
+    recs = recommender.recommend('id5', features=features, top=10, cluster_priority=True)
+    expected = _brute_force(data, 'id5', features, data['cluster'] == data.loc[5, 'cluster']).head(10)
+    assert list(recs['name']) == list(expected['name']), "Same-cluster ranking should match the brute-force sort."
+    assert list(recs['similarity']) == [f"{x:.2f}%" for x in expected['similarity']], "Scores should be formatted percentages."
+
+    recs = recommender.recommend('id5', features=features, top=10, cluster_priority=False)
+    expected = _brute_force(data, 'id5', features).head(10)
+    assert list(recs['name']) == list(expected['name']), "Global ranking should match the brute-force sort."
+    assert list(recs.columns) == ['name', 'artists', 'similarity', 'cluster'], "Returned columns should be unchanged."
+
+def test_recommend_many_matches_recommend():
+    """Test that blocked batch scoring returns the same songs as per-target recommend, including the global fallback."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(120, seed=1)
+    data = processor.clusterData(n_clusters=30)  # small clusters force the global fallback for some targets
+    recommender = Recommender(data)
+    features = ['valence', 'danceability', 'acousticness']
+    target_ids = ['id0', 'id7', 'id42', 'id99', 'id119']
+
+    batch = recommender.recommend_many(target_ids, features, top=6, block_size=2, catalog_block=25)
+    assert list(batch.columns) == ['seed_id', 'rank', 'id', 'name', 'artists', 'similarity', 'cluster']
+    for targetID in target_ids:
+        single = recommender.recommend(targetID, features, top=6)
+        rows = batch[batch['seed_id'] == targetID]
+        assert list(rows['rank']) == list(range(1, 7)), "Ranks should run from 1 to top."
+        assert list(rows['name']) == list(single['name']), "Batch results should match recommend."
+        assert [f"{x:.2f}%" for x in rows['similarity']] == list(single['similarity']), "Scores should match recommend."
+
+def test_cluster_probed_recall():
+    """Test that cluster-probed search reaches full recall when every cluster is scanned."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(400, seed=2)
+    data = processor.clusterData(n_clusters=8)
+    recommender = Recommender(data, processor.cluster_model)
+    features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+    target_ids = [f"id{i}" for i in range(0, 400, 40)]
+
+    assert recommender.recallAtK(target_ids, features, top=10, n_probe=8) == 1.0, "Probing every cluster is an exact search."
+    assert 0 < recommender.recallAtK(target_ids, features, top=10, n_probe=2) <= 1.0
+    recs = recommender.recommend('id3', features, top=10, n_probe=1)
+    assert len(recs) == 10, "Probing should widen until there are enough candidates."
+    recs = recommender.recommend('id3', ['acousticness', 'energy'], top=10, n_probe=8)
+    expected = recommender.recommend('id3', ['energy', 'acousticness'], top=10, cluster_priority=False)
+    assert list(recs['name']) == list(expected['name']), "Probing with a feature subset in any order should work."
+
+def test_artifact_round_trip(tmp_path):
+    """Test that the saved pipeline artifact is reused until the source CSV changes."""
+    path = tmp_path / "tracks.csv"
+    _random_tracks(60).to_csv(path, index=False)
+    artifacts = tmp_path / "artifacts"
+
+    built = DataProcessor(path).loadOrBuild(artifacts, n_clusters=3).copy()
+    processor = DataProcessor(path)
+    loaded = processor.loadArtifact(artifacts, n_clusters=3)
+    assert loaded is not None, "A matching artifact should be loaded."
+    assert list(loaded['id']) == list(built['id'].astype(str)), "Rows should round-trip in order."
+    assert np.allclose(loaded['tempo'], built['tempo']), "Normalized features should round-trip."
+    assert (loaded['cluster'] == built['cluster']).all(), "Cluster labels should round-trip."
+    assert processor.cluster_model.n_clusters == 3 and processor.feature_stats is not None
+    assert DataProcessor(path).loadArtifact(artifacts, n_clusters=4) is None, "Different parameters need a rebuild."
+
+    _random_tracks(61).to_csv(path, index=False)
+    assert DataProcessor(path).loadArtifact(artifacts, n_clusters=3) is None, "A changed CSV needs a rebuild."
+
+def test_artifact_strings_are_packed(tmp_path):
+    """Test that artifact strings take their UTF-8 size, not rows x longest string, and round-trip exactly."""
+    tracks = _random_tracks(500)
+    tracks.loc[0, 'artists'] = 'x' * 5000
+    tracks.loc[1, 'name'] = 'Canción für 東京'
+    path = tmp_path / "tracks.csv"
+    tracks.to_csv(path, index=False)
+    artifacts = tmp_path / "artifacts"
+    processor = DataProcessor(path)
+    processor.loadOrBuild(artifacts, n_clusters=3)
+    target = artifacts / processor.artifact_key
+    assert (target / 'artists_bytes.npy').stat().st_size < 20000, "A single long value should not pad every row."
+    loaded = DataProcessor(path).loadArtifact(artifacts, n_clusters=3)
+    assert list(loaded['name']) == list(tracks['name']) and list(loaded['artists']) == list(tracks['artists']), "Strings should round-trip."
+
+def test_feature_store_matches_dataframe(tmp_path):
+    """Test that a recommender over the memory-mapped feature store gives the same results as one over the DataFrame."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(150, seed=3)
+    data = processor.clusterData(n_clusters=5)
+    store = FeatureStore.build(tmp_path / "store", data)
+    in_memory, mapped = Recommender(data), Recommender(FeatureStore(tmp_path / "store"))
+    features = ['energy', 'valence', 'acousticness']
+
+    for cluster_priority in (True, False):
+        expected = in_memory.recommend('id9', features, top=8, cluster_priority=cluster_priority)
+        recs = mapped.recommend('id9', features, top=8, cluster_priority=cluster_priority)
+        assert list(recs['name']) == list(expected['name']), "The store should rank songs like the DataFrame."
+        assert list(recs['cluster']) == list(expected['cluster'])
+    matrix = store.matrix(features)
+    assert isinstance(matrix.matrix, np.memmap) and isinstance(matrix.inverse_norms, np.memmap), "Features should be memory-mapped, not loaded."
+    assert sorted(p.name for p in (tmp_path / "store").glob('*.npy') if 'matrix' in p.name or 'features' in p.name) == ['features.npy'], \
+        "The features should be stored once, not one matrix per selection."
+    with pytest.raises(IndexError):
+        mapped.recommend('missing', features)
+
+    rebuilt = FeatureStore.build(tmp_path / "store", data.iloc[:10])   # a second build never replaces an open store
+    assert len(rebuilt) == len(store) == 150 and len(mapped.recommend('id9', features, top=8)) == 8
+
+def test_concurrent_recommendations():
+    """Test many parallel requests with different feature selections against one shared recommender."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(500, seed=4)
+    data = processor.clusterData(n_clusters=6)
+    recommender = Recommender(data)
+    all_features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+    rng = np.random.default_rng(4)
+    queries = []
+    for _ in range(300):
+        features = [str(f) for f in rng.choice(all_features, size=rng.integers(2, 6), replace=False)]  # one feature ties every score
+        queries.append((f"id{rng.integers(500)}", features))
+
+    def run(query):
+        targetID, features = query
+        return list(recommender.recommend(targetID, features, top=5)['name'])
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(run, queries))
+
+    for (targetID, features), names in zip(queries, results):
+        cluster = data.loc[data['id'] == targetID, 'cluster'].values[0]
+        expected = _brute_force(data, targetID, features, data['cluster'] == cluster)
+        assert names == list(expected['name'].head(5)), f"Wrong results for {targetID} with {features}."
+    assert list(data.columns) == ['id', 'name', 'artists'] + all_features + ['cluster'], "Requests should not touch the dataset."
+
+def test_search_index():
+    """Test ranked, capped song search against a plain substring filter."""
+    data = pd.DataFrame({
+        'id': ['1', '2', '3', '4', '5'],
+        'name': ['Love Story', 'Lovely', 'Crazy in Love', 'Hello', 'Yesterday'],
+        'artists': ['Taylor Swift', 'Billie Eilish', 'Beyonce', 'Adele', 'Lovers Club']
+    })
+    index = SearchIndex(data)
+
+    results = index.search('LOVE')
+    assert [song_id for song_id, _, _ in results] == ['1', '2', '3', '5'], "Prefix matches, then substring, then artist matches."
+    assert len(index.search('love', limit=2)) == 2, "Results should be capped at the limit."
+    assert index.search('xyz') == [], "Unknown text should return nothing."
+
+    catalog = _random_tracks(500)
+    index = SearchIndex(catalog)
+    expected = set(catalog.loc[catalog['name'].str.contains('ong4', case=False), 'id'])
+    assert {song_id for song_id, _, _ in index.search('ong4', limit=1000)} == expected, "Results should match str.contains."
+
+def test_compact_load_with_cache(tmp_path):
+    """Test the compact loader and its sidecar cache."""
+    path = tmp_path / "tracks.csv"
+    _random_tracks(40).assign(popularity=1).to_csv(path, index=False)
+
+    processor = DataProcessor(path)
+    data = processor.loadData(compact=True, cache=True)
+    assert list(data.columns) == ['id', 'name', 'artists', 'valence', 'danceability', 'energy', 'tempo', 'acousticness']
+    assert data['tempo'].dtype == np.float32 and isinstance(data['artists'].dtype, pd.CategoricalDtype)
+    assert processor.load_stats['source'] == 'csv'
+
+    cached = processor.loadData(compact=True, cache=True)
+    assert processor.load_stats['source'] == 'cache', "An unchanged CSV should be read from the cache."
+    pd.testing.assert_frame_equal(cached, data)
+
+    _random_tracks(41).to_csv(path, index=False)
+    assert len(processor.loadData(compact=True, cache=True)) == 41 and processor.load_stats['source'] == 'csv'
+
+    InputData.drop(columns=['tempo']).to_csv(path, index=False)
+    with pytest.raises(ValueError):
+        processor.loadData(compact=True)
+
+def test_stream_process_matches_in_memory(tmp_path):
+    """Test that the chunked two-pass pipeline matches clean + preprocessData on the whole file."""
+    data = _random_tracks(90, seed=5)
+    data.loc[[3, 40, 77], 'energy'] = np.nan
+    data.loc[[10, 50], 'name'] = np.nan
+    data = pd.concat([data, data.iloc[[5, 6, 60]], data.iloc[[5]]])   # duplicates spread over several chunks
+    source, output = tmp_path / "tracks.csv", tmp_path / "processed.csv"
+    data.to_csv(source, index=False)
+
+    processor = DataProcessor(source)
+    processor.loadData()
+    processor.clean()
+    expected = processor.preprocessData()
+
+    streamed = DataProcessor(source)
+    counts = streamed.streamProcess(output, chunksize=7)
+    result = pd.read_csv(output)
+    assert counts == {'rows_in': 94, 'rows_out': 88}, "Duplicates and rows missing a name should be dropped."
+    assert list(result['id']) == list(expected['id']), "Rows should be kept in source order."
+    features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+    assert np.allclose(result[features].to_numpy(), expected[features].to_numpy()), "Streaming should match the in-memory path."
+    assert np.isclose(streamed.feature_stats['energy']['std'], processor.feature_stats['energy']['std'])
+
+def test_add_tracks_updates_clusters():
+    """Test incremental assignment of new songs and the running-mean centroid update."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(2000, seed=6)
+    processor.clusterData(n_clusters=3)
+    features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+
+    new = _random_tracks(2300, seed=7).iloc[2000:].assign(id=lambda d: 'new' + d['id'])
+    centers = processor.cluster_model.cluster_centers_.copy()
+    counts = np.bincount(processor.data['cluster'], minlength=3)[:, None]
+    report = processor.addTracks(pd.concat([new, processor.data.iloc[:5]]))   # known ids are skipped
+    assert report['songs_added'] == 300 and len(processor.data) == 2300
+    added = processor.data.iloc[2000:]
+    assert added['cluster'].notna().all(), "New songs should get a cluster."
+    sums = added.groupby('cluster')[features].sum().reindex(range(3), fill_value=0).to_numpy()
+    added_counts = np.bincount(added['cluster'], minlength=3)[:, None]
+    expected = (centers * counts + sums) / (counts + added_counts)
+    assert np.allclose(processor.cluster_model.cluster_centers_, expected), "Centroids should move to the running mean."
+    assert not report['needs_refit'], "Songs like the existing ones should not call for a refit."
+
+    far = new.assign(id=lambda d: 'far' + d['id'], tempo=1000.0)
+    assert processor.addTracks(far)['needs_refit'], "Songs far from every centroid should call for a refit."
+
+    recs = Recommender(processor.data, processor.cluster_model).recommend('newid2100', features, top=5)
+    assert len(recs) == 5, "Added songs should be usable with cluster priority."
+
+def test_auto_cluster_count():
+    """Test that automatic cluster count selection finds well separated groups."""
+    rng = np.random.default_rng(8)
+    centers = np.array([[0, 0, 0, 0, 0], [5, 5, 0, 0, 0], [0, 5, 5, 0, 5], [5, 0, 5, 5, 0]])
+    data = _random_tracks(160)
+    features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+    data[features] = np.repeat(centers, 40, axis=0) + rng.normal(0, 0.3, (160, 5))
+
+    processor = DataProcessor(None)
+    processor.data = data
+    clustered = processor.clusterData(n_clusters='auto', k_range=range(2, 8), top=5, n_jobs=2)
+    assert processor.k_selection['chosen'] == 4, "The four separated groups should be found."
+    assert clustered['cluster'].nunique() == 4
+    assert [result['k'] for result in processor.k_selection['results']] == list(range(2, 8))
+    assert all(result['seconds'] > 0 for result in processor.k_selection['results']), "Per-k timings should be recorded."
+
+def test_auto_cluster_count_fits_sample(tmp_path):
+    """Test that automatic selection fits candidates on the sample, reuses the winner and keeps its scores in the artifact."""
+    rng = np.random.default_rng(9)
+    centers = np.array([[0, 0, 0, 0, 0], [5, 5, 0, 0, 0], [0, 5, 5, 0, 5], [5, 0, 5, 5, 0]])
+    data = _random_tracks(800)
+    features = ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+    data[features] = np.repeat(centers, 200, axis=0) + rng.normal(0, 0.3, (800, 5))
+    path = tmp_path / "tracks.csv"
+    data.to_csv(path, index=False)
+
+    processor = DataProcessor(path)
+    processor.data = data
+    clustered = processor.clusterData(n_clusters='auto', k_range=range(2, 7), top=5, n_jobs=2, sample_size=200)
+    assert processor.k_selection['chosen'] == 4 and processor.k_selection['sample_size'] == 200
+    assert len(processor.cluster_model.labels_) == 200, "The chosen model should be the one fitted on the sample, not a refit."
+    assert clustered['cluster'].nunique() == 4 and min(result['min_size'] for result in processor.k_selection['results']) > 5
+
+    processor.saveArtifact(tmp_path / "artifacts", n_clusters='auto')
+    loaded = DataProcessor(path)
+    assert loaded.loadModel(tmp_path / "artifacts", n_clusters='auto') is not None
+    assert loaded.k_selection == json.loads(json.dumps(processor.k_selection)), "Per-k scores should survive the artifact."
+
+def test_neighbor_graph(tmp_path):
+    """Test that precomputed neighbour tables give the same recommendations as live scoring."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(300, seed=9)
+    data = processor.clusterData(n_clusters=20)   # some clusters smaller than k exercise the fallback
+    live, cached = Recommender(data), Recommender(data)
+    features = ['valence', 'danceability', 'energy']
+    graph = NeighborGraph.build(tmp_path / "graph", live, features, k=8, n_jobs=2, block_size=64, catalog_block=100)
+    cached.attachNeighbors(graph)
+    assert graph.neighbors.dtype == np.int32 and graph.scores.dtype == np.float16
+
+    for targetID in ['id0', 'id33', 'id150', 'id299']:
+        expected = live.recommend(targetID, features, top=8)
+        recs = cached.recommend(targetID, list(reversed(features)), top=8)
+        assert list(recs['name']) == list(expected['name']), "The table should match live scoring."
+        diffs = [abs(float(a[:-1]) - float(b[:-1])) for a, b in zip(recs['similarity'], expected['similarity'])]
+        assert max(diffs) < 0.1, "float16 scores should stay close to the live ones."
+    assert not graph.matches(['valence', 'energy'], 8, True) and not graph.matches(features, 9, True)
+    assert len(cached.recommend('id0', ['valence', 'energy'], top=8)) == 8, "Other requests should fall back to live scoring."
+
+def test_result_cache():
+    """Test memoized recommendations, LRU eviction, TTL expiry and invalidation on new data."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(200, seed=10)
+    data = processor.clusterData(n_clusters=3)
+    recommender = Recommender(data, processor.cluster_model, cache_size=2)
+    features = ['valence', 'energy']
+
+    first = recommender.recommend('id1', features)
+    first['name'] = 'changed'   # callers get a copy
+    again = recommender.recommend('id1', list(reversed(features)))
+    assert recommender.cacheStats()['results']['hits'] == 1, "Same song and feature set should hit the cache."
+    assert list(again['name']) == list(Recommender(data).recommend('id1', features)['name'])
+
+    recommender.recommend('id2', features)
+    recommender.recommend('id3', features)
+    stats = recommender.cacheStats()['results']
+    assert stats['evictions'] == 1 and stats['size'] == 2, "The least recently used result should be evicted."
+
+    recommender.data = data.iloc[:100]
+    assert recommender.cacheStats()['results']['size'] == 0, "New data should invalidate the cache."
+
+    now = [0.0]
+    cache = ResultCache(ttl=10, clock=lambda: now[0])
+    cache.put('key', 'value')
+    now[0] = 11.0
+    assert cache.get('key') is None and cache.stats()['evictions'] == 1, "Expired entries should be dropped."
+
+def test_micro_batched_endpoint():
+    """Test that concurrent API requests are coalesced into batches and each caller gets its own top-k."""
+    processor = DataProcessor(None)
+    processor.data = _random_tracks(400, seed=9)
+    data = processor.clusterData(n_clusters=5)
+    recommender = Recommender(data)
+    app = uiLogin(recommender, data, batch_size=32, batch_wait=0.05)
+    client = app.server.test_client()
+    features = ['valence', 'energy', 'acousticness']
+    queries = [(f"id{i * 7}", 3 + i % 4) for i in range(40)]
+
+    def run(query):
+        targetID, top = query
+        return client.post('/api/recommend', json={'id': targetID, 'features': features, 'top': top})
+
+    with ThreadPoolExecutor(max_workers=40) as pool:
+        responses = list(pool.map(run, queries))
+
+    for (targetID, top), response in zip(queries, responses):
+        assert response.status_code == 200, "Valid requests should succeed."
+        expected = recommender.recommend(targetID, features, top=top)
+        assert [rec['name'] for rec in response.get_json()['recommendations']] == list(expected['name']), f"Wrong results for {targetID}."
+
+    stats = client.get('/api/recommend/stats').get_json()
+    assert stats['requests'] == 40 and stats['batches'] < 40, "Concurrent requests should share batches."
+    assert sum(stats['batch_size_histogram'].values()) == stats['batches'], "Every batch should be counted once."
+    assert client.post('/api/recommend', json={'id': 'missing'}).status_code == 404, "Unknown songs should return 404."
+    assert client.post('/api/recommend', json={'id': 'id1', 'features': ['loudness']}).status_code == 400, "Unknown features should return 400."
+    app.batcher.close()
+
+class _FakeSpotify(BaseHTTPRequestHandler):
+    """Serves /me/playlists and /playlists/<id>/tracks from self.server.playlists, two playlists per page, and /audio-features."""
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        offset, limit = int(query.get('offset', [0])[0]), int(query.get('limit', [20])[0])
+        self.server.paths.append(url.path)
+        if url.path == '/audio-features':
+            ids = query['ids'][0].split(',')
+            self.server.batches.append(len(ids))
+            features = [None if i == 'unknown' else {'id': i, 'valence': 0.5, 'danceability': 0.4, 'energy': 0.3,
+                                                     'tempo': 100.0 + int(i[1:]), 'acousticness': 0.2} for i in ids]
+            return self._send({'audio_features': features})
+        if url.path == '/me/playlists':
+            limit = 2
+            items = [{'id': pid, 'name': p['name'], 'snapshot_id': p['snapshot_id']} for pid, p in self.server.playlists.items()]
+        else:
+            pid = url.path.split('/')[2]
+            if pid in self.server.drop:   # close the connection without a response
+                self.server.drop.remove(pid)
+                self.close_connection = True
+                return
+            if pid in self.server.stall:  # answer after the client has timed out
+                self.server.stall.remove(pid)
+                time.sleep(1.0)
+            if pid in self.server.throttle:
+                self.server.throttle.remove(pid)
+                self.send_response(429)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                return
+            items = self.server.playlists[pid]['tracks']
+        base = f"http://127.0.0.1:{self.server.server_port}{url.path}"
+        body = {'items': items[offset:offset + limit],
+                'next': f"{base}?offset={offset + limit}&limit={limit}" if offset + limit < len(items) else None}
+        self._send(body)
+
+    def _send(self, body):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+def _fake_track(i):
+    return {'track': {'id': f't{i}', 'name': f'Track {i}', 'artists': [{'name': 'A'}, {'name': 'B'}],
+                      'album': {'name': 'Album', 'release_date': '2020'}, 'duration_ms': 1000 + i, 'popularity': i % 100}}
+
+def test_export_playlists_against_fake_api(tmp_path):
+    """Test pagination, 429 retries and snapshot-based skipping of the playlist exporter."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeSpotify)
+    server.paths, server.throttle, server.drop, server.stall = [], {'p2'}, set(), set()
+    server.playlists = {
+        'p1': {'name': 'Big', 'snapshot_id': 's1', 'tracks': [_fake_track(i) for i in range(250)]},
+        'p2': {'name': 'Small', 'snapshot_id': 's1', 'tracks': [_fake_track(i) for i in range(3)]},
+        'p3': {'name': 'Removed', 'snapshot_id': 's1', 'tracks': [_fake_track(7), {'track': None}]},
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = getSpotify.SpotifyClient('token', base_url=f"http://127.0.0.1:{server.server_port}")
+        output = str(tmp_path / 'playlists.csv')
+        assert getSpotify.export_playlists_to_csv(client, output) == {'fetched': 3, 'reused': 0}
+        rows = pd.read_csv(output)
+        assert rows.groupby('Playlist ID').size().to_dict() == {'p1': 250, 'p2': 3, 'p3': 1}, "Every page should be exported."
+        assert rows.loc[rows['Playlist ID'] == 'p2', 'Artists'].iloc[0] == 'A, B', "Artists should be joined."
+
+        server.paths.clear()
+        server.playlists['p2']['snapshot_id'] = 's2'
+        server.playlists['p2']['tracks'].append(_fake_track(99))
+        assert getSpotify.export_playlists_to_csv(client, output) == {'fetched': 1, 'reused': 2}
+        assert not any(path.startswith('/playlists/p1') for path in server.paths), "Unchanged playlists should not be fetched."
+        rows = pd.read_csv(output)
+        assert rows.groupby('Playlist ID').size().to_dict() == {'p1': 250, 'p2': 4, 'p3': 1}, "Unchanged playlists should be kept."
+    finally:
+        server.shutdown()
+
+def test_export_retries_network_errors(tmp_path):
+    """Test that dropped connections and timeouts are retried instead of aborting the export."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeSpotify)
+    server.paths, server.throttle, server.drop, server.stall = [], set(), {'p1'}, {'p2'}
+    server.playlists = {'p1': {'name': 'Dropped', 'snapshot_id': 's1', 'tracks': [_fake_track(i) for i in range(5)]},
+                        'p2': {'name': 'Slow', 'snapshot_id': 's1', 'tracks': [_fake_track(i) for i in range(2)]}}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = getSpotify.SpotifyClient('token', base_url=f"http://127.0.0.1:{server.server_port}", timeout=0.3, sleep=lambda seconds: None)
+        assert getSpotify.export_playlists_to_csv(client, str(tmp_path / 'playlists.csv')) == {'fetched': 2, 'reused': 0}
+        assert pd.read_csv(tmp_path / 'playlists.csv').groupby('Playlist ID').size().to_dict() == {'p1': 5, 'p2': 2}
+        assert not server.drop and not server.stall, "Both failures should have been hit and retried."
+
+        server.drop.add('p1')
+        with pytest.raises(OSError):
+            getSpotify.SpotifyClient('token', base_url=f"http://127.0.0.1:{server.server_port}", max_retries=0).get('/playlists/p1/tracks')
+    finally:
+        server.shutdown()
+
+def test_enrich_with_audio_features(tmp_path):
+    """Test deduped, batched and cached audio feature enrichment into a loadable dataset."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeSpotify)
+    server.paths, server.throttle, server.batches = [], set(), []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = getSpotify.SpotifyClient('token', base_url=f"http://127.0.0.1:{server.server_port}")
+        playlists = tmp_path / 'playlists.csv'
+        rows = [{'Playlist Name': 'P', 'Track Name': f'Track {i}', 'Artists': 'A', 'Track ID': f't{i}', 'Playlist ID': 'p'} for i in range(250)]
+        rows += rows[:40] + [{'Playlist Name': 'Q', 'Track Name': 'Gone', 'Artists': 'A', 'Track ID': 'unknown', 'Playlist ID': 'q'}]
+        pd.DataFrame(rows, columns=getSpotify.FIELDNAMES).to_csv(playlists, index=False)
+        output, cache = str(tmp_path / 'dataset.csv'), str(tmp_path / 'features.sqlite')
+
+        stats = getSpotify.enrich_with_audio_features(client, str(playlists), output, cache)
+        assert stats == {'tracks': 251, 'fetched': 251, 'written': 250}, "Duplicates should be fetched once and unknown tracks dropped."
+        assert sorted(server.batches) == [51, 100, 100], "Ids should be requested in batches of at most 100."
+
+        processor = DataProcessor(output)
+        data = processor.loadData()
+        assert len(data) == 250 and data.loc[data['id'] == 't7', 'tempo'].iloc[0] == 107, "The dataset should load with its features."
+
+        server.batches.clear()
+        rows.append({'Playlist Name': 'P', 'Track Name': 'New', 'Artists': 'A', 'Track ID': 't900', 'Playlist ID': 'p'})
+        pd.DataFrame(rows, columns=getSpotify.FIELDNAMES).to_csv(playlists, index=False)
+        stats = getSpotify.enrich_with_audio_features(client, str(playlists), output, cache)
+        assert stats['fetched'] == 1 and server.batches == [1], "Cached tracks should not be requested again."
+        assert stats['written'] == 251, "New tracks should be added to the dataset."
+    finally:
+        server.shutdown()
+
+def test_recommend_playlist():
+    """Test centroid and multi-vector playlist continuation against a direct computation, with seed exclusion and artist caps."""
+    data = _random_tracks(600, seed=11)
+    recommender = Recommender(data)
+    features = ['valence', 'energy', 'acousticness']
+    seeds = ['id3', 'id50', 'id77', 'id3', 'not-in-dataset']
+    values = data[features].values / np.linalg.norm(data[features].values, axis=1)[:, None]
+    seed_values = values[[3, 50, 77]]
+    centroid = seed_values.mean(axis=0) / np.linalg.norm(seed_values.mean(axis=0))
+    others = ~data['id'].isin(seeds).values
+
+    for mode, scores in [('centroid', values @ centroid), ('multi-vector', (values @ seed_values.T).max(axis=1))]:
+        recs = recommender.recommendPlaylist(seeds, features, top=8, mode=mode, catalog_block=128)
+        expected = data[others].assign(score=scores[others]).sort_values('score', ascending=False)
+        assert list(recs['name']) == list(expected['name'].head(8)), f"Wrong {mode} ranking."
+
+    capped = recommender.recommendPlaylist(seeds, features, top=14, per_artist_cap=2)
+    assert len(capped) == 14 and capped['artists'].value_counts().max() <= 2, "No artist should exceed the cap."
+    assert not capped['name'].isin(['Song3', 'Song50', 'Song77']).any(), "Seeds should be excluded."
+    with pytest.raises(IndexError):
+        recommender.recommendPlaylist(['missing'], features)
+
+def test_benchmark_harness(tmp_path):
+    """Test the synthetic catalog generator and the baseline comparison of the benchmark harness."""
+    tracks = benchmark.generateTracks(5000, seed=3)
+    assert tracks.equals(benchmark.generateTracks(5000, seed=3)), "The generator should be deterministic."
+    assert 50 < tracks.duplicated().sum() < 150, "About 2% of the rows should be duplicates."
+    assert tracks['tempo'].dropna().between(40, 220).all() and tracks['valence'].dropna().between(0, 1).all(), "Features should stay in range."
+
+    results = benchmark.main([3000], cluster_counts=[4], queries=10, directory=str(tmp_path))
+    run = results['runs']['rows=3000']
+    assert {'loadData', 'clean', 'preprocessData', 'searchIndex', 'clusterData[k=4]'} <= set(run['stages']), "Every stage should be timed."
+    for variant in ['loadData[full]', 'loadData[compact]', 'loadData[compact+cache]']:
+        assert run['stages'][variant]['seconds'] > 0 and 'peak_rss_mb' in run['stages'][variant], f"{variant} should be measured."
+    assert run['stages']['loadData[compact+cache]']['source'] == 'cache', "The cached variant should read the sidecar."
+    assert run['stages']['loadData[compact]']['frame_bytes'] < run['stages']['loadData[full]']['frame_bytes']
+    if benchmark._resetPeakRss():
+        big = np.ones(20_000_000)   # 160 MB
+        del big
+        before = benchmark._processPeakRss()
+        benchmark._resetPeakRss()
+        assert benchmark._processPeakRss() < before - 100, "A reset should drop earlier peaks from the next stage."
+        assert all('peak_rss_mb' in run['stages'][name] for name in ['clean', 'preprocessData', 'clusterData[k=4]'])
+    assert set(run['recommend']['k=4']) == {'+'.join(features) for features in benchmark.FEATURE_SUBSETS}, "Every subset should be measured."
+    assert benchmark.compare(results, results) == [], "A run should not regress against itself."
+    slower = json.loads(json.dumps(results))
+    slower['runs']['rows=3000']['search']['p99_ms'] *= 2
+    assert [r['metric'] for r in benchmark.compare(slower, results)] == ['rows=3000/search/p99_ms'], "Slowdowns should be reported."
+
+def test_metrics_instrumentation(tmp_path):
+    """Test stage, recommend phase and callback metrics on the /metrics endpoint, and slow request profiles."""
+    metrics.reset()
+    metrics.enabled = True
+    try:
+        processor = DataProcessor(None)
+        processor.data = _random_tracks(300, seed=12)
+        processor.clean()
+        processor.preprocessData()
+        data = processor.clusterData(n_clusters=4)
+        recommender = Recommender(data)
+        recommender.recommend('id5', ['valence', 'energy'])
+        app = uiLogin(recommender, data)
+        body = app.server.test_client().get('/metrics').get_data(as_text=True)
+        app.batcher.close()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+
+    for stage in ['clean', 'preprocessData', 'clusterData']:
+        assert f'spotify_stage_seconds_count{{stage="{stage}"}} 1' in body, f"{stage} should be timed once."
+        assert f'spotify_stage_memory_delta_bytes{{stage="{stage}"}}' in body, f"{stage} should report its memory delta."
+    for phase in ['lookup', 'candidates', 'scoring', 'ranking', 'results']:
+        assert f'spotify_recommend_phase_seconds_count{{phase="{phase}"}} 1' in body, f"The {phase} phase should be timed."
+    assert 'spotify_recommend_seconds_bucket{le="+Inf"} 1' in body, "Whole recommendations should be timed."
+
+    profiled = Metrics(enabled=True, profile_dir=str(tmp_path), slow_threshold=0)
+    slow = profiled.timed('callback_seconds', profile=True, callback='slow')(lambda: sum(range(1000)))
+    assert slow() == 499500 and len(list(tmp_path.glob('callback_seconds-slow-*.prof'))) == 1, "Slow calls should be profiled."
+    assert Metrics().timer('anything') is Metrics().timer('other'), "Disabled timers should be a shared no-op."
+
+def test_pipeline_background_reload(tmp_path):
+    """Test non-blocking startup, readiness and the snapshot swap when the dataset changes."""
+    path = tmp_path / 'data.csv'
+    _random_tracks(400, seed=13).to_csv(path, index=False)
+    pipeline = Pipeline(str(path), str(tmp_path / 'artifacts'), n_clusters=3, poll_interval=0.05)
+    app = uiLogin(pipeline=pipeline)
+    client = app.server.test_client()
+    assert client.get('/ready').status_code == 503, "The server should answer before the pipeline is built."
+    assert client.post('/api/recommend', json={'id': 'id1'}).status_code == 503, "Requests should wait for the first snapshot."
+
+    pipeline.start()
+    try:
+        assert pipeline.waitReady(60), "The first snapshot should be built in the background."
+        status = client.get('/ready').get_json()
+        assert status['ready'] and status['version'] == 1 and status['last_reload_seconds'] is not None
+        old = pipeline.snapshot
+
+        _random_tracks(500, seed=14).to_csv(path, index=False)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))   # coarse file system clocks
+        deadline = time.monotonic() + 60
+        while pipeline.snapshot.version == 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pipeline.snapshot.version == 2 and len(pipeline.snapshot.recommender.data) == 500, "A changed dataset should be reloaded."
+        assert len(old.recommender.recommend('id1', ['valence', 'energy'])) == 5, "The old snapshot should keep serving."
+        assert client.post('/api/recommend', json={'id': 'id450'}).status_code == 200, "Requests should use the new snapshot."
+    finally:
+        pipeline.stop()
+        app.batcher.close()
+
+def test_reload_prunes_artifacts_and_handles_dropped_songs(tmp_path):
+    """Test that reloads keep only the current and previous artifacts and a song dropped by a reload gives a message."""
+    path = tmp_path / 'data.csv'
+    artifacts = tmp_path / 'artifacts'
+    pipeline = Pipeline(str(path), str(artifacts), n_clusters=3)
+    keys = []
+    for rows in [400, 300, 200]:
+        _random_tracks(rows, seed=rows).to_csv(path, index=False)
+        assert pipeline.reload(), pipeline.last_error
+        keys.append(pipeline.snapshot.artifact_key)
+    assert sorted(p.name for p in artifacts.iterdir() if (p / 'manifest.json').exists()) == sorted(keys[1:]), "Older artifacts should be deleted."
+
+    app = uiLogin(pipeline=pipeline)
+    payload = {'output': 'recommendations-output.children', 'outputs': {'id': 'recommendations-output', 'property': 'children'},
+               'inputs': [{'id': 'recommend-button', 'property': 'n_clicks', 'value': 1}],
+               'state': [{'id': 'song-dropdown', 'property': 'value', 'value': 'id350'},   # only in the first dataset
+                         {'id': 'recommendation-parameters', 'property': 'value', 'value': ['valence', 'energy']}],
+               'changedPropIds': ['recommend-button.n_clicks']}
+    response = app.server.test_client().post('/_dash-update-component', json=payload)
+    app.batcher.close()
+    assert response.status_code == 200 and 'no longer in the catalog' in response.get_data(as_text=True), "A dropped song should give a message."
+
+def test_malformed_requests_do_not_stop_batcher():
+    """Test that malformed API requests are rejected and never stop the batching worker."""
+    data = _random_tracks(200, seed=15)
+    recommender = Recommender(data)
+    app = uiLogin(recommender, data, request_timeout=5)
+    client = app.server.test_client()
+    for body in [{'id': ['x']}, {'id': 'id1', 'features': 'valence'}, {'id': 'id1', 'top': True}, {'id': 'id1', 'top': 10 ** 9},
+                 {'id': 'id1', 'cluster_priority': 'yes'}, ['id1']]:
+        assert client.post('/api/recommend', json=body).status_code == 400, f"{body} should be rejected."
+
+    with pytest.raises(TypeError):
+        app.batcher.recommend(['x'], ['valence'], timeout=5)   # bypasses the validation of the endpoint
+    with pytest.raises(TypeError):
+        app.batcher.recommend('id1', [['valence']], timeout=5)
+    assert app.batcher._worker.is_alive(), "The worker should survive malformed requests."
+    response = client.post('/api/recommend', json={'id': 'id1', 'features': ['valence', 'energy']})
+    assert response.status_code == 200 and len(response.get_json()['recommendations']) == 5, "Valid requests should still be answered."
+    app.batcher.close()
+
+def test_pipeline_serves_from_store_only(tmp_path, monkeypatch):
+    """Test that a rebuild with an existing store never loads the dataset into pandas and searches the store."""
+    path = tmp_path / 'data.csv'
+    tracks = _random_tracks(300, seed=16)
+    tracks.to_csv(path, index=False)
+    pipeline = Pipeline(str(path), str(tmp_path / 'artifacts'), n_clusters=3)
+    first = pipeline.build(1)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The dataset should not be loaded again.")
+    monkeypatch.setattr(DataProcessor, 'loadData', fail)
+    monkeypatch.setattr(DataProcessor, 'loadArtifact', fail)
+    second = pipeline.build(2)
+    assert isinstance(second.recommender.data, FeatureStore) and not hasattr(second, 'data'), "Snapshots should hold no DataFrame."
+    assert second.features == first.features == ['valence', 'danceability', 'energy', 'tempo', 'acousticness']
+
+    in_memory = SearchIndex(tracks)
+    for query in ['song1', 'ARTIST3', 'ng2', 'zzz']:
+        assert second.search_index.search(query, limit=20) == in_memory.search(query, limit=20), f"Store search differs for {query}."
+
+def test_masked_matrix_reuses_row_norms():
+    """Test that by default each feature selection normalizes the catalog once, with the same results as the matrix cache."""
+    data = _random_tracks(400, seed=17)
+    processor = DataProcessor(None)
+    processor.data = data
+    data = processor.clusterData(n_clusters=4)
+    uncached, cached = Recommender(data), Recommender(data, matrix_cache_size=31)
+    for features in [['valence', 'energy'], ['energy', 'valence'], ['tempo', 'acousticness', 'danceability']]:
+        for cluster_priority in [True, False]:
+            for targetID in ['id3', 'id99']:
+                assert uncached.recommend(targetID, features, cluster_priority=cluster_priority).equals(
+                    cached.recommend(targetID, features, cluster_priority=cluster_priority)), f"Results differ for {features}."
+    assert len(uncached._inverse_norms) == 2, "Each feature selection should be normalized once, whatever its order."
+    assert uncached.cacheStats()['matrices']['size'] == 0, "The default should never copy the catalog per selection."
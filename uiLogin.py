@@ -1,9 +1,28 @@
+from concurrent.futures import TimeoutError as FutureTimeout
+
 from dash import Dash, html, dcc, callback, Input, Output, State
+from flask import Response, jsonify, request
+
+from Metrics import metrics
+from MicroBatcher import MicroBatcher
+from Pipeline import Snapshot
+
+MAX_SONG_OPTIONS = 50  # cap on dropdown options sent to the browser per search
+MAX_TOP = 100  # cap on recommendations per API request, a batch is scored at its largest top
+NOT_READY = "The song catalog is still loading, please try again in a moment."
 
-def uiLogin(recommender, df):
+def uiLogin(recommender=None, df=None, batch_size=64, batch_wait=0.005, pipeline=None, request_timeout=10.0):
 
     # Initialize the app
     app = Dash(__name__, suppress_callback_exceptions=True)
+    if pipeline is None:
+        static = Snapshot(recommender, df)  # fixed dataset, the search index is built once
+        current = lambda: static
+    else:
+        current = lambda: pipeline.snapshot  # swapped by the pipeline on reload, None until the first build finishes
+    # every batch runs on the snapshot current when it starts
+    batcher = MicroBatcher(lambda: current().recommender, max_batch=batch_size, max_wait=batch_wait)
+    app.batcher = batcher
 
     # Login page layout
     login_layout = html.Div([
@@ -88,6 +107,7 @@ def uiLogin(recommender, df):
         Input('submit-val', 'n_clicks'),
         prevent_initial_call=True
     )
+    @metrics.timed('callback_seconds', profile=True, callback='navigate_to_dashboard')
     def navigate_to_dashboard(n_clicks):
         return '/dashboard' if n_clicks > 0 else '/'
 
@@ -95,6 +115,7 @@ def uiLogin(recommender, df):
         Output('page-content', 'children'),
         Input('url', 'pathname')
     )
+    @metrics.timed('callback_seconds', profile=True, callback='display_page')
     def display_page(pathname):
         if pathname == '/':
             return login_layout
@@ -107,23 +128,29 @@ def uiLogin(recommender, df):
         Output('song-search-output', 'children'),
         Input('song-search-input', 'value')
     )
+    @metrics.timed('callback_seconds', profile=True, callback='update_song_options')
     def update_song_options(search_value):
-        if len(search_value) < 3:
+        if not search_value or len(search_value) < 3:
             return "Please enter at least 3 characters."
         
-        filtered_df = df[df['name'].str.contains(search_value, case=False, na=False)]
-        if filtered_df.empty:
+        snapshot = current()
+        if snapshot is None:
+            return NOT_READY
+        matches = snapshot.search_index.search(search_value, limit=MAX_SONG_OPTIONS + 1)
+        if not matches:
             return "No matching songs found."
         
+        note = f"Showing the top {MAX_SONG_OPTIONS} matches, refine the search to narrow them down." if len(matches) > MAX_SONG_OPTIONS else None
         return html.Div([
             dcc.Dropdown(
                 id='song-dropdown',
                 options=[
-                    {'label': name, 'value': song_id} for name, song_id in zip(filtered_df['name'], filtered_df['id'])
+                    {'label': f"{name} - {artists}", 'value': song_id} for song_id, name, artists in matches[:MAX_SONG_OPTIONS]
                 ],
                 placeholder='Select a song...',
                 style={'width': '100%', 'color': 'black'}
-            )
+            ),
+            html.Div(note, style={'paddingTop': '5px'})
         ])
 
     # Get and display recommendations when btn is pressed
@@ -134,23 +161,79 @@ def uiLogin(recommender, df):
         State('recommendation-parameters', 'value'), # update on features select
         prevent_initial_call=True # prevent callback before user interaction
     )
+    @metrics.timed('callback_seconds', profile=True, callback='get_recommendations')
     def get_recommendations(n_clicks, song_id, parameters):
         if not song_id or not parameters:
             return "Please select a song and parameters for recommendations."
         
+        snapshot = current()  # held until the response is built, even if a reload swaps in a new one
+        if snapshot is None:
+            return NOT_READY
+        
         # Ensure the parameters exist in the data
-        available_columns = df.columns.tolist()
+        available_columns = snapshot.features
         missing_columns = [param for param in parameters if param not in available_columns]
         
         if missing_columns:
             return f"The following parameters are missing from the data: {', '.join(missing_columns)}"
         
-        recommender.data = df[parameters + ['id', 'name', 'artists']]  # Pass the selected parameters
-        recommendations = recommender.recommend(song_id, parameters)
+        try:
+            recommendations = snapshot.recommender.recommend(song_id, parameters)  # only the selected parameters are scored
+        except IndexError:   # picked from the dropdown of a snapshot that a reload has since replaced
+            return "The selected song is no longer in the catalog, please search for it again."
 
         # Formatted ecommendations as HTML list
-        return html.Ul([html.Li(f"{rec['name']} by {rec['artists']}") for rec in recommendations.to_dict('records')])
+        with metrics.timer('callback_phase_seconds', callback='get_recommendations', phase='render'):
+            return html.Ul([html.Li(f"{rec['name']} by {rec['artists']}") for rec in recommendations.to_dict('records')])
+
+
+    # JSON API for other services, requests arriving together are answered in one batch
+    @app.server.route('/api/recommend', methods=['POST'])
+    def api_recommend():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify({'error': "The request body must be a JSON object."}), 400
+        song_id = body.get('id')
+        parameters = body.get('features', ['valence', 'danceability', 'energy'])
+        top = body.get('top', 5)
+        cluster_priority = body.get('cluster_priority', True)
+        snapshot = current()
+        if snapshot is None:
+            return jsonify({'error': NOT_READY}), 503
+        if not isinstance(song_id, str) or not song_id:
+            return jsonify({'error': "'id' must be a non-empty string."}), 400
+        if not isinstance(parameters, list) or not parameters or not all(isinstance(param, str) for param in parameters):
+            return jsonify({'error': "'features' must be a non-empty list of strings."}), 400
+        if not isinstance(top, int) or isinstance(top, bool) or not 1 <= top <= MAX_TOP:
+            return jsonify({'error': f"'top' must be an integer between 1 and {MAX_TOP}."}), 400
+        if not isinstance(cluster_priority, bool):
+            return jsonify({'error': "'cluster_priority' must be true or false."}), 400
+        missing_columns = [param for param in parameters if param not in snapshot.features]
+        if missing_columns:
+            return jsonify({'error': f"The following parameters are missing from the data: {', '.join(missing_columns)}"}), 400
+
+        try:
+            recommendations = batcher.recommend(song_id, parameters, top, cluster_priority, timeout=request_timeout)
+        except IndexError as error:
+            return jsonify({'error': str(error)}), 404
+        except FutureTimeout:
+            return jsonify({'error': "The recommendation timed out."}), 504
+        except Exception as error:
+            return jsonify({'error': f"The recommendation could not be computed: {error}"}), 503
+        return jsonify({'id': song_id, 'features': parameters, 'recommendations': recommendations})
+
+    @app.server.route('/api/recommend/stats', methods=['GET'])
+    def api_recommend_stats():
+        return jsonify(batcher.stats())
+
+    @app.server.route('/ready', methods=['GET'])
+    def ready():
+        status = pipeline.status() if pipeline is not None else {'ready': True, 'version': static.version}
+        return jsonify(status), 200 if status['ready'] else 503
 
+    @app.server.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
 
     # App Layout
     app.layout = html.Div([